@@ -9,9 +9,9 @@
 #
 
 import os
-import pandas as pd
-import pydicom
-import matplotlib.pyplot as plt
+import glob
+# pandas、pydicom和matplotlib导入较慢，只在用到的函数中导入，
+# 只用sum_columns、perfusion_image_list的脚本不需要付出这些导入开销
 
 
 dect_dataset_path = r"E:\cjfh\dectpe"
@@ -25,6 +25,8 @@ def plot_ct_image(ct_dirpath, index):
         ct_dirpath: path of ct image;
         index: number of the ct sequence;
     '''
+    import pydicom
+    import matplotlib.pyplot as plt
     dicom_files = os.listdir(ct_dirpath)
     # 使用 pydicom 读取 DICOM 文件
     dicom_data = pydicom.dcmread(os.path.join(ct_dirpath, dicom_files[index]))
@@ -48,6 +50,8 @@ def run_plot_ct_image():
 # 把DICOM图像文件转换为Excel文件，不同的分量使用不同的Sheet，方便查看
 #
 def convert_dicom_excel(dicom_file, excel_file):
+    import pydicom
+    import pandas as pd
     # 读取DICOM文件
     dicom_data = pydicom.dcmread(dicom_file)
     # 获取像素数据
@@ -107,6 +111,15 @@ def perfusion_image_list(dir_path):
     return image_list
 
 
+# 列出患者CT目录中的所有dcm文件名
+def list_dcm_files(directory):
+    # 使用 glob 模块列出当前目录中的所有.dcm 文件
+    dcm_files = glob.glob(os.path.join(directory, 'CT', '*.dcm'))
+    # 过滤出文件（排除子目录），并获取文件名
+    dcm_file_names = [os.path.basename(file) for file in dcm_files if os.path.isfile(file)]
+    return dcm_file_names
+
+
 
 
 # 把df中指定的列累加起来返回
@@ -139,6 +152,7 @@ def perfusion_percent(df):
 
 
 def run_perfusion_percent():
+    import pandas as pd
     df = pd.read_excel(r'E:\cjfh\dectpe\raw\allcases_result\allcases244_stat_resunet.xlsx')
     perfusion_percent(df)
     df.to_excel(r'E:\cjfh\dectpe\raw\allcases_result\allcases244_percent_resunet.xlsx.xlsx')
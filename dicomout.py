@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+#
+# Title: 把每个患者的灌注标签图和彩色图保存为多帧DICOM(RLE无损压缩)，可以直接导入PACS
+# Author:
+# Refer:
+# Repo:
+# Date: 2024-12-xx
+#
+
+
+import datetime
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.tag import Tag
+from pydicom.uid import RLELossless, generate_uid
+try:
+    from pydicom.pixels.encoders import RLELosslessEncoder
+except ImportError:  # pydicom 2.x
+    from pydicom.encoders import RLELosslessEncoder
+
+
+# Multi-frame Grayscale Byte / True Color Secondary Capture Image Storage
+LABEL_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.7.2'
+COLOR_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.7.4'
+
+# 从原始CT复制的患者、检查和几何信息
+REFERENCE_TAGS = [
+    'PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex', 'PatientAge',
+    'StudyInstanceUID', 'StudyDate', 'StudyTime', 'StudyID', 'AccessionNumber', 'ReferringPhysicianName',
+    'StudyDescription', 'FrameOfReferenceUID', 'PositionReferenceIndicator',
+    'PixelSpacing', 'ImageOrientationPatient', 'SliceThickness', 'SpacingBetweenSlices',
+]
+
+
+# 单帧RLE编码，写入线程中逐帧压缩，不需要在内存中保留整个体数据
+def encode_label_frame(label):
+    label = np.ascontiguousarray(label, dtype=np.uint8)
+    return RLELosslessEncoder.encode(
+        label, rows=label.shape[0], columns=label.shape[1], samples_per_pixel=1, bits_allocated=8,
+        bits_stored=8, pixel_representation=0, photometric_interpretation='MONOCHROME2', number_of_frames=1)
+
+
+def encode_color_frame(color):
+    color = np.ascontiguousarray(color, dtype=np.uint8)
+    return RLELosslessEncoder.encode(
+        color, rows=color.shape[0], columns=color.shape[1], samples_per_pixel=3, bits_allocated=8,
+        bits_stored=8, pixel_representation=0, photometric_interpretation='RGB', planar_configuration=0,
+        number_of_frames=1)
+
+
+# 每帧沿层面法线方向的位置(mm)，没有方向信息时为z坐标
+def slice_locations(image_positions, orientation=None):
+    positions = np.asarray(image_positions, dtype=float)
+    if orientation is None:
+        return positions[:, 2]
+    orientation = np.asarray(orientation, dtype=float)
+    normal = np.cross(orientation[:3], orientation[3:])
+    return positions @ normal
+
+
+# 写入多帧DICOM
+def write_multiframe_dicom(path, frames, shape, reference, image_positions, color=False,
+                           series_description='', series_number=900):
+    '''
+        frames: 每帧RLE编码后的bytes(按切片顺序);
+        shape: 每帧的(行, 列);
+        reference: 原始CT的DICOM头(复制患者、检查和几何信息);
+        image_positions: 每帧对应的ImagePositionPatient，没有时为None;
+        color: True为RGB彩色图，False为uint8标签图;
+    '''
+    sop_class_uid = COLOR_SOP_CLASS_UID if color else LABEL_SOP_CLASS_UID
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = RLELossless
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    # 先设置字符集，否则中文姓名等非ASCII的值会被替换为'?'
+    ds.SpecificCharacterSet = reference.get('SpecificCharacterSet', 'ISO_IR 192')
+    for keyword in REFERENCE_TAGS:
+        if keyword in reference:
+            setattr(ds, keyword, getattr(reference, keyword))
+    now = datetime.datetime.now()
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SeriesNumber = series_number
+    ds.SeriesDescription = series_description
+    ds.InstanceNumber = 1
+    ds.Modality = 'OT'
+    ds.ConversionType = 'WSD'
+    ds.ImageType = ['DERIVED', 'SECONDARY']
+    ds.BurnedInAnnotation = 'NO'
+    ds.ContentDate = now.strftime('%Y%m%d')
+    ds.ContentTime = now.strftime('%H%M%S')
+
+    ds.NumberOfFrames = len(frames)
+    ds.Rows, ds.Columns = shape
+    ds.BitsAllocated = 8
+    ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    if color:
+        ds.SamplesPerPixel = 3
+        ds.PhotometricInterpretation = 'RGB'
+        ds.PlanarConfiguration = 0
+    else:
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        # 标签值0-3: 0肺外，1正常灌注，2灌注减低，3灌注缺损
+        ds.WindowCenter = 1.5
+        ds.WindowWidth = 4
+        ds.ImageComments = '0=background 1=normal 2=reduced 3=defect'
+
+    # 每帧的空间位置使用SC Multi-frame Vector模块: 第一帧的ImagePositionPatient加上每帧的SliceLocationVector
+    # (SC的IOD不包含Functional Groups)；没有位置信息时按页码排列
+    if image_positions and all(p is not None for p in image_positions):
+        ds.ImagePositionPatient = list(image_positions[0])
+        locations = slice_locations(image_positions, reference.get('ImageOrientationPatient'))
+        ds.SliceLocationVector = [round(float(x), 4) for x in locations]
+        ds.FrameIncrementPointer = Tag('SliceLocationVector')
+        steps = np.diff(locations)
+        if 'SpacingBetweenSlices' not in ds and steps.size and np.allclose(steps, steps[0], atol=1e-3):
+            ds.SpacingBetweenSlices = round(abs(float(steps[0])), 4)
+    else:
+        ds.PageNumberVector = list(range(1, len(frames) + 1))
+        ds.FrameIncrementPointer = Tag('PageNumberVector')
+    ds.PixelData = encapsulate(list(frames))
+    ds['PixelData'].VR = 'OB'
+    if int(pydicom.__version__.split('.')[0]) >= 3:
+        ds.save_as(path, enforce_file_format=True)
+    else:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(path, write_like_original=False)
+    return path
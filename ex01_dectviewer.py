@@ -8,36 +8,178 @@
 # Date: 2024-05-07
 # History:
 # 1. 实现阅读DECT PBV数据
+# 2. 后台生成缩略图金字塔(缓存到磁盘)，增加可拖动的缩略图条快速跳转切片
 #
 
 
 import os
 import sys
+import hashlib
+import numpy as np
 import pydicom
 from PySide6.QtWidgets import QApplication, QLabel, QMainWindow, QScrollArea, QVBoxLayout, QWidget
-from PySide6.QtGui import QPixmap, QImage
-from PySide6.QtCore import Qt
+from PySide6.QtGui import QPixmap, QImage, QPainter, QColor, QPen
+from PySide6.QtCore import Qt, QThread, QRect, Signal
+
+
+# 缩略图缓存目录
+THUMBNAIL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dectlung', 'thumbnails')
+THUMBNAIL_CACHE_VERSION = 2
+
+
+# 把整个序列(N, H, W, 3)或灰度序列(N, H, W)一次性按2x2取平均逐级缩小，返回各级RGB缩略图(不含原图)
+def build_thumbnail_pyramid(volume, levels=3, should_stop=None):
+    if volume.ndim == 3:
+        volume = volume[..., np.newaxis]
+    # 16位的CT/PBV灰度图先线性缩放到0-255，否则转为uint8时会按256取模
+    if volume.dtype != np.uint8:
+        volume = volume.astype(np.float32)
+        low, high = volume.min(), volume.max()
+        volume = (volume - low) * (255.0 / max(high - low, 1e-6))
+    pyramid = []
+    level = volume
+    for _ in range(levels):
+        if should_stop is not None and should_stop():
+            break
+        n, height, width, channel = level.shape
+        height, width = height // 2, width // 2
+        if height == 0 or width == 0:
+            break
+        blocks = level[:, :height * 2, :width * 2].reshape(n, height, 2, width, 2, channel)
+        level = blocks.mean(axis=(2, 4), dtype=np.float32).round().astype(np.uint8)
+        pyramid.append(level)
+    # 灰度图只在缩小后复制为3个通道
+    return [np.repeat(level, 3, axis=-1) if level.shape[-1] == 1 else level for level in pyramid]
+
+
+# 缓存文件名由目录、文件名、大小和修改时间决定，序列变化后自动重新生成
+def thumbnail_cache_path(directory):
+    digest = hashlib.sha1(os.path.abspath(directory).encode('utf-8'))
+    # 缩略图的生成方法改变后不再使用旧的缓存
+    digest.update(f'v{THUMBNAIL_CACHE_VERSION};'.encode('utf-8'))
+    for entry in os.listdir(directory):
+        stat = os.stat(os.path.join(directory, entry))
+        digest.update(f'{entry}:{stat.st_size}:{stat.st_mtime_ns};'.encode('utf-8'))
+    return os.path.join(THUMBNAIL_CACHE_DIR, digest.hexdigest() + '.npz')
+
+
+# 后台线程: 读取缓存或生成缩略图金字塔，不阻塞界面
+class ThumbnailBuilder(QThread):
+    pyramid_ready = Signal(list)
+
+    def __init__(self, dicom_images, directory=None, levels=3, parent=None):
+        super().__init__(parent)
+        self.dicom_images = dicom_images
+        self.directory = directory
+        self.levels = levels
+
+    def run(self):
+        cache_path = thumbnail_cache_path(self.directory) if self.directory else None
+        if cache_path and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                self.pyramid_ready.emit([cached[f'level{i}'] for i in range(len(cached.files))])
+            return
+        # 关闭窗口时requestInterruption()，逐个切片检查，尽快退出
+        images = []
+        for ds in self.dicom_images:
+            if self.isInterruptionRequested():
+                return
+            images.append(ds.pixel_array)
+        pyramid = build_thumbnail_pyramid(np.stack(images), self.levels, self.isInterruptionRequested)
+        if self.isInterruptionRequested():  # 不缓存不完整的金字塔
+            return
+        if cache_path:
+            os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+            np.savez(cache_path, **{f'level{i}': level for i, level in enumerate(pyramid)})
+        self.pyramid_ready.emit(pyramid)
+
+
+# 缩略图条: 均匀抽取整个序列的缩略图，点击或拖动跳转到对应切片
+class MontageStrip(QWidget):
+    index_selected = Signal(int)
+
+    def __init__(self, count, height=72, parent=None):
+        super().__init__(parent)
+        self.count = count
+        self.current_index = 0
+        self.thumbnails = None
+        self.setFixedHeight(height)
+
+    def set_pyramid(self, pyramid):
+        # 选择高度不超过缩略图条的最大一级
+        fitting = [level for level in pyramid if level.shape[1] <= self.height()]
+        self.thumbnails = fitting[0] if fitting else pyramid[-1]
+        self.update()
+
+    def set_current_index(self, index):
+        self.current_index = index
+        self.update()
+
+    def index_at(self, x):
+        if self.count <= 1:
+            return 0
+        return int(round(min(max(x / max(self.width() - 1, 1), 0.0), 1.0) * (self.count - 1)))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.black)
+        if self.thumbnails is not None and self.count > 0:
+            thumb_height, thumb_width = self.thumbnails.shape[1:3]
+            cell_width = max(1, thumb_width * self.height() // thumb_height)
+            cells = max(1, self.width() // cell_width)
+            for cell in range(cells):
+                index = self.index_at((cell + 0.5) * self.width() / cells)
+                thumb = np.ascontiguousarray(self.thumbnails[index])
+                q_image = QImage(thumb.data, thumb_width, thumb_height, 3 * thumb_width, QImage.Format_RGB888)
+                painter.drawImage(QRect(cell * self.width() // cells, 0, cell_width, self.height()), q_image)
+        # 当前切片的位置
+        if self.count > 1:
+            x = self.current_index * (self.width() - 1) // (self.count - 1)
+            painter.setPen(QPen(QColor(255, 255, 0), 2))
+            painter.drawLine(x, 0, x, self.height())
+        painter.end()
+
+    def mousePressEvent(self, event):
+        self.index_selected.emit(self.index_at(event.position().x()))
+
+    def mouseMoveEvent(self, event):
+        if event.buttons() & Qt.LeftButton:
+            self.index_selected.emit(self.index_at(event.position().x()))
+
 
 class DicomViewer(QMainWindow):
-    def __init__(self, dicom_images):
+    def __init__(self, dicom_images, directory=None):
         super().__init__()
         self.dicom_images = dicom_images  # List of DICOM image data
+        self.directory = directory
         self.current_image_index = 0
         self.initUI()
 
     def initUI(self):
         self.setWindowTitle("DECT Image Browser")
-        self.setGeometry(100, 100, 512, 512)
+        self.setGeometry(100, 100, 512, 600)
         # Create a label to display DICOM images
         self.image_label = QLabel()
         self.image_label.setAlignment(Qt.AlignCenter)
-        self.setCentralWidget(self.image_label)
+        # Montage strip for jumping to any slice
+        self.montage_strip = MontageStrip(len(self.dicom_images))
+        self.montage_strip.index_selected.connect(self.show_image)
+        container = QWidget()
+        layout = QVBoxLayout(container)
+        layout.addWidget(self.image_label, 1)
+        layout.addWidget(self.montage_strip)
+        self.setCentralWidget(container)
 
         self.load_image(self.current_image_index)
 
         # Enable mouse wheel event
         self.image_label.wheelEvent = self.scroll_images
 
+        # Build the thumbnail pyramid in the background
+        self.thumbnail_builder = ThumbnailBuilder(self.dicom_images, self.directory, parent=self)
+        self.thumbnail_builder.pyramid_ready.connect(self.montage_strip.set_pyramid)
+        self.thumbnail_builder.start()
+
     def load_image(self, index):
         # Convert DICOM image data to QImage
         image_data = self.dicom_images[index].pixel_array
@@ -48,6 +190,12 @@ class DicomViewer(QMainWindow):
         pixmap = QPixmap.fromImage(q_image)
         self.image_label.setPixmap(pixmap)
 
+    def show_image(self, index):
+        if index != self.current_image_index:
+            self.current_image_index = index
+            self.load_image(index)
+        self.montage_strip.set_current_index(index)
+
     def scroll_images(self, event):
         # Change the image index based on the mouse wheel movement
         delta = event.angleDelta().y()
@@ -56,6 +204,12 @@ class DicomViewer(QMainWindow):
         elif delta < 0 and self.current_image_index < len(self.dicom_images) - 1:
             self.current_image_index += 1
         self.load_image(self.current_image_index)
+        self.montage_strip.set_current_index(self.current_image_index)
+
+    def closeEvent(self, event):
+        self.thumbnail_builder.requestInterruption()
+        self.thumbnail_builder.wait()
+        super().closeEvent(event)
 
 def load_dicom_images(directory):
     # Load DICOM images from a directory and return a list of DICOM image data
@@ -72,7 +226,7 @@ def show_pbv_images(pbv_dirpath):
     dir_path = os.path.join(pbv_dirpath)
     dicom_images = load_dicom_images(dir_path)
     # Create and show the DICOM browser
-    browser = DicomViewer(dicom_images)
+    browser = DicomViewer(dicom_images, dir_path)
     browser.show()
     sys.exit(app.exec())
 
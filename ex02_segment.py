@@ -10,9 +10,9 @@
 
 import numpy as np
 import pydicom
-import matplotlib.pyplot as plt
 from scipy.ndimage import distance_transform_edt
 from skimage import color, morphology, filters, measure, exposure, segmentation
+from lungbox import lung_bounding_box, paste_bounding_box
 
 def watershed_segment_lungs(dicom_file):
     # 读取DICOM文件
@@ -20,7 +20,11 @@ def watershed_segment_lungs(dicom_file):
 
     # 获取CT图像数据
     ct_image = dicom_data.pixel_array
+    return watershed_segment_lungs_from_image(ct_image)
 
+
+# 从已解码的CT图像分割(供maskprovider等复用)
+def watershed_segment_lungs_from_image(ct_image):
     # 将图像转换为灰度图像
     gray = exposure.rescale_intensity(ct_image, out_range=(0, 1))
     # 应用高斯模糊以减少噪声
@@ -95,6 +99,7 @@ def watershed_segment_lungs(dicom_file):
 # 指定DICOM文件路径
 def run_watershed_segment_lungs():
     ct_file = r'E:\cjfh\dectpe\raw\typical\case2\CT\IMG-0002-00137.dcm'
+    import matplotlib.pyplot as plt
     # 分割肺部区域并绘制轮廓线
     segmented_image, left_lung_mask, right_lung_mask = watershed_segment_lungs(ct_file)
     print(left_lung_mask)
@@ -105,34 +110,46 @@ def run_watershed_segment_lungs():
 
 
 # 评估双肺的灌注情况并显示
-def extract_lung_perfusion(pbv_file, left_lung_mask, right_lung_mask):
+def extract_lung_perfusion(pbv_file, left_lung_mask, right_lung_mask, lean=False):
     # 读取PVB图像
     pbv_data = pydicom.dcmread(pbv_file)
     pbv_image = pbv_data.pixel_array
 
-    # 归一化PVB图像到0-1范围
-    pvb_normalized = exposure.rescale_intensity(pbv_image, out_range=(0, 1))
+    # 只在双肺的外接矩形内计算，结果最后放回整幅图像
+    box = lung_bounding_box(left_lung_mask | right_lung_mask)
+    pbv_crop = pbv_image[box]
+    # 节省内存模式下使用float32
+    if lean:
+        pbv_crop = pbv_crop.astype(np.float32)
+
+    # 归一化PVB图像到0-1范围(最小值和最大值仍取整幅图像)
+    pvb_normalized = exposure.rescale_intensity(pbv_crop, in_range=(pbv_image.min(), pbv_image.max()), out_range=(0, 1))
 
     # 应用左肺和右肺掩码提取功能图像
-    right_lung_perfusion = pvb_normalized * right_lung_mask
-    left_lung_perfusion = pvb_normalized * left_lung_mask
+    right_lung_perfusion = pvb_normalized * right_lung_mask[box]
+    left_lung_perfusion = pvb_normalized * left_lung_mask[box]
 
     # 定义灌注状态的阈值
     normal_threshold = 0.6
     defect_threshold = 0.3
 
     # 评估左肺每个像素的灌注状态
-    left_lung_status = np.zeros_like(left_lung_perfusion, dtype=int)
+    left_lung_status = np.zeros_like(left_lung_perfusion, dtype=np.uint8)
     left_lung_status[left_lung_perfusion >= normal_threshold] = 2  # 正常灌注
     left_lung_status[(left_lung_perfusion >= defect_threshold) & (left_lung_perfusion < normal_threshold)] = 1  # 灌注减低
     left_lung_status[left_lung_perfusion < defect_threshold] = 0  # 灌注缺损
 
     # 评估右肺每个像素的灌注状态
-    right_lung_status = np.zeros_like(right_lung_perfusion, dtype=int)
+    right_lung_status = np.zeros_like(right_lung_perfusion, dtype=np.uint8)
     right_lung_status[right_lung_perfusion >= normal_threshold] = 2  # 正常灌注
     right_lung_status[
         (right_lung_perfusion >= defect_threshold) & (right_lung_perfusion < normal_threshold)] = 1  # 灌注减低
     right_lung_status[right_lung_perfusion < defect_threshold] = 0  # 灌注缺损
+
+    # 放回整幅图像
+    left_lung_perfusion, right_lung_perfusion, left_lung_status, right_lung_status = [
+        paste_bounding_box(image, pbv_image.shape, box)
+        for image in (left_lung_perfusion, right_lung_perfusion, left_lung_status, right_lung_status)]
     return left_lung_perfusion, right_lung_perfusion, left_lung_status, right_lung_status
 
 
@@ -140,6 +157,7 @@ def extract_lung_perfusion(pbv_file, left_lung_mask, right_lung_mask):
 def run_extract_lung_perfusion():
     ct_filepath = r'E:\cjfh\dectpe\raw\typical\case1\CT\IMG-0001-00097.dcm'
     pbv_filepath = r'E:\cjfh\dectpe\raw\typical\case1\PBV-blackwhite\IMG-0016-00097.dcm'
+    import matplotlib.pyplot as plt
     # 分割肺部区域并绘制轮廓线
     segmented_image, left_lung_mask, right_lung_mask = watershed_segment_lungs(ct_filepath)
     left_perfusion, right_perfusion, left_status, right_status = extract_lung_perfusion(pbv_filepath, left_lung_mask,
@@ -9,17 +9,23 @@
 #
 
 
+import io
 import os
-import glob
+import queue
+import threading
 import numpy as np
-import pandas as pd
 import pydicom
 from skimage import exposure
-from scipy.ndimage import label
+from scipy.ndimage import label, distance_transform_edt
 from skimage.filters import threshold_otsu
 from skimage.measure import label, regionprops
 from skimage.segmentation import clear_border
-import matplotlib.pyplot as plt
+from lungbox import lung_bounding_box, paste_bounding_box
+from dataset import list_dcm_files
+import maskstore
+import maskprovider
+import pbvstats
+# pandas、matplotlib和dicomout只在用到的函数中导入，只做分割和分级时不需要付出这些导入开销
 
 
 # 读取DICOM文件
@@ -29,6 +35,12 @@ def get_ct_mask(ct_file):
 
     # 获取CT图像数据
     ct_image = dicom_data.pixel_array
+    return maskprovider.assign_sides_by_anatomy(*get_ct_mask_from_image(ct_image),
+                                                dicom_data.get('ImageOrientationPatient'))
+
+
+# 从已解码的CT图像分割肺部掩码(流水线中读取和计算分开进行)
+def get_ct_mask_from_image(ct_image):
     b = ct_image
     mask = b < 600
     #plt.figure(1)
@@ -49,8 +61,7 @@ def get_ct_mask(ct_file):
     if len(areas) > 2:
         for region in regionprops(label_image):
             if region.area < areas[-2]:
-                for coordinates in region.coords:
-                    label_image[coordinates[0], coordinates[1]] = 0
+                label_image[region.coords[:, 0], region.coords[:, 1]] = 0
     lung_mask = label_image > 0
     #plt.figure(4)
     #plt.imshow(mask, cmap=plt.cm.bone)
@@ -62,16 +73,15 @@ def get_ct_mask(ct_file):
 
     for region in regionprops(label_image):
         if region.area == areas[-1]:    # 最大的区域为右肺
-            for coordinates in region.coords:
-                right_lung_mask[coordinates[0], coordinates[1]] = 1
+            right_lung_mask[region.coords[:, 0], region.coords[:, 1]] = 1
         elif region.area == areas[-2]:  # 第二大的区域为左肺
-            for coordinates in region.coords:
-                left_lung_mask[coordinates[0], coordinates[1]] = 1
+            left_lung_mask[region.coords[:, 0], region.coords[:, 1]] = 1
     return lung_mask, right_lung_mask, left_lung_mask
 
 
 def run01_generate_ct_mask():
     ct_file = r'E:\cjfh\dectpe\raw\typical\case2\CT\IMG-0002-00137.dcm'
+    import matplotlib.pyplot as plt
     lung_mask, right_lung_mask, left_lung_mask = get_ct_mask(ct_file)
     plt.figure()
     plt.imshow(lung_mask, cmap=plt.cm.bone)
@@ -83,9 +93,18 @@ def extract_lung_perfusion(pbv_file, lung_mask, right_lung_mask, left_lung_mask,
     # 读取PVB图像
     pbv_data = pydicom.dcmread(pbv_file)
     pbv_image = pbv_data.pixel_array
+    return classify_lung_perfusion(pbv_image, lung_mask, right_lung_mask, left_lung_mask, adaptive)
+
 
-    # 归一化PVB图像到0-1范围
-    pvb_normalized = exposure.rescale_intensity(pbv_image, out_range=(0, 1))
+# 对已解码的PBV图像进行灌注分级
+def classify_lung_perfusion(pbv_image, lung_mask, right_lung_mask, left_lung_mask, adaptive=False, verbose=True):
+    # 只在肺的外接矩形内计算，结果最后放回整幅图像
+    box = lung_bounding_box(lung_mask)
+    lung_mask, right_lung_mask, left_lung_mask = lung_mask[box], right_lung_mask[box], left_lung_mask[box]
+
+    # 归一化PVB图像到0-1范围(最小值和最大值仍取整幅图像)
+    pvb_normalized = exposure.rescale_intensity(pbv_image[box], in_range=(pbv_image.min(), pbv_image.max()),
+                                                out_range=(0, 1))
 
     #对掩码进行统计
     lung_count = np.sum(lung_mask)
@@ -99,20 +118,21 @@ def extract_lung_perfusion(pbv_file, lung_mask, right_lung_mask, left_lung_mask,
 
     # 定义灌注状态的阈值
     if adaptive:
-        # 应用Otsu's方法确定最优阈值
-        threshold = threshold_otsu(lung_perfusion)
+        # 应用Otsu's方法确定最优阈值(矩形外的像素都为0)
+        threshold = otsu_threshold_masked(lung_perfusion.ravel(), pbv_image.size - lung_perfusion.size)
         normal_threshold = threshold * 2.2   # 正常阈值为最优阈值的2.2倍
         defect_threshold = threshold * 1.85  # 缺损阈值为最优阈值的1.85倍
     else:
         normal_threshold = 0.55
         defect_threshold = 0.45
-    print(normal_threshold)
-    print(defect_threshold)
+    if verbose:
+        print(normal_threshold)
+        print(defect_threshold)
 
     # 创建彩色灌注图像
-    lung_perfusion_color = np.zeros((pbv_image.shape[0], pbv_image.shape[1], 3))
-    right_lung_perfusion_color = np.zeros((pbv_image.shape[0], pbv_image.shape[1], 3))
-    left_lung_perfusion_color = np.zeros((pbv_image.shape[0], pbv_image.shape[1], 3))
+    lung_perfusion_color = np.zeros((lung_mask.shape[0], lung_mask.shape[1], 3))
+    right_lung_perfusion_color = np.zeros((lung_mask.shape[0], lung_mask.shape[1], 3))
+    left_lung_perfusion_color = np.zeros((lung_mask.shape[0], lung_mask.shape[1], 3))
 
     # 评估全肺每个像素的灌注状态
     lung_normal = lung_perfusion >= normal_threshold
@@ -143,11 +163,242 @@ def extract_lung_perfusion(pbv_file, lung_mask, right_lung_mask, left_lung_mask,
     left_lung_perfusion_color[left_lung_normal] = [0, 1, 0]   # 正常灌注为绿色
     left_lung_perfusion_color[left_lung_defect] = [1, 0, 0]   # 灌注缺损为红色
     left_lung_perfusion_color[left_lung_reduced] = [0, 0, 1]  # 灌注减低为蓝色
+
+    # 放回整幅图像
+    lung_perfusion, lung_perfusion_color, right_lung_perfusion, right_lung_perfusion_color, \
+        left_lung_perfusion, left_lung_perfusion_color = [
+            paste_bounding_box(image, pbv_image.shape, box) for image in (
+                lung_perfusion, lung_perfusion_color, right_lung_perfusion, right_lung_perfusion_color,
+                left_lung_perfusion, left_lung_perfusion_color)]
     return lung_perfusion, lung_perfusion_color, right_lung_perfusion, right_lung_perfusion_color, left_lung_perfusion, left_lung_perfusion_color,\
     right_lung_count, right_normal_count, right_defect_count, right_reduced_count, left_lung_count, left_normal_count, left_defect_count, left_reduced_count
 
 
+# 灌注分级的标签值(uint8)及对应颜色
+LABEL_NONE = 0
+LABEL_NORMAL = 1    # 正常灌注为绿色
+LABEL_REDUCED = 2   # 灌注减低为蓝色
+LABEL_DEFECT = 3    # 灌注缺损为红色
+PERFUSION_LUT = np.array([[0, 0, 0], [0, 255, 0], [0, 0, 255], [255, 0, 0]], dtype=np.uint8)
+
+# 左右肺的标签值(uint8)
+SIDE_NONE = 0
+SIDE_RIGHT = 1
+SIDE_LEFT = 2
+
+
+# 由掩码内的像素值和掩码外0值的个数重建直方图，得到与threshold_otsu(lung_perfusion)相同的阈值
+def otsu_threshold_masked(values, n_zeros, nbins=256):
+    if values.size == 0:
+        return 0.0
+    lo = 0.0 if n_zeros else values.min()
+    hi = values.max()
+    if lo == hi:
+        return lo
+    counts, bin_edges = np.histogram(values, bins=nbins, range=(lo, hi))
+    counts[0] += n_zeros
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.
+    return threshold_otsu(hist=(counts, bin_centers))
+
+
+# 由左右肺掩码得到uint8的左右肺标签图
+def side_label_from_masks(right_lung_mask, left_lung_mask):
+    side_label = np.zeros(right_lung_mask.shape, dtype=np.uint8)
+    side_label[right_lung_mask] = SIDE_RIGHT
+    side_label[left_lung_mask] = SIDE_LEFT
+    return side_label
+
+
+# 肺内像素的一维索引，像素数小于2^31时使用int32(比int64省一半)，分块计算避免整幅的int64临时数组
+def lung_pixel_index(lung_mask, chunk_size=1 << 16):
+    flat = lung_mask.reshape(-1)
+    if flat.size >= 2 ** 31:
+        return np.flatnonzero(flat)
+    parts = [np.flatnonzero(flat[start:start + chunk_size]).astype(np.int32) + np.int32(start)
+             for start in range(0, flat.size, chunk_size)]
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int32)
+
+
+# 节省内存的灌注分级: 只对肺内像素计算float32归一化值，结果为uint8标签图，不生成float64的灌注图和彩色图
+def classify_lung_perfusion_lean(pbv_image, lung_mask, right_lung_mask, left_lung_mask, adaptive=False, verbose=True):
+    '''
+        返回 lung_label(uint8灌注分级), side_label(uint8左右肺), 以及与classify_lung_perfusion相同的8个计数
+    '''
+    lung_index = lung_pixel_index(lung_mask)
+    side_label = side_label_from_masks(right_lung_mask, left_lung_mask)
+    lung_classes, *counts = classify_lung_perfusion_index(pbv_image, lung_index, side_label.ravel()[lung_index],
+                                                          adaptive, verbose)
+    lung_label = np.zeros(pbv_image.shape, dtype=np.uint8)
+    lung_label.ravel()[lung_index] = lung_classes
+    return (lung_label, side_label, *counts)
+
+
+# 由肺内像素的一维索引进行灌注分级，不需要整幅的掩码(可以直接使用掩码文件中的索引)
+def classify_lung_perfusion_index(pbv_image, lung_index, lung_sides, adaptive=False, verbose=True, histogram=None,
+                                  value_range=None):
+    '''
+        lung_index: 肺内像素的一维索引;
+        lung_sides: 与lung_index对应的左右肺标签(SIDE_RIGHT/SIDE_LEFT);
+        histogram: pbvstats.PerfusionHistogram，不为None时同时统计归一化PBV值的分布;
+        value_range: 归一化使用的(最小值, 最大值)，默认取pbv_image的范围(降采样时应传入原始图像的范围);
+        返回 lung_classes(与lung_index对应的uint8灌注分级), 以及与classify_lung_perfusion相同的8个计数
+    '''
+    # 归一化PVB图像到0-1范围，只计算肺内的像素
+    lo, hi = value_range if value_range is not None else (pbv_image.min(), pbv_image.max())
+    scale = np.float32(1.0 / (float(hi) - float(lo))) if hi > lo else np.float32(0)
+    lung_values = (pbv_image.ravel()[lung_index].astype(np.float32) - np.float32(lo)) * scale
+    if histogram is not None:
+        histogram.add_slice(lung_values, lung_sides)
+
+    # 定义灌注状态的阈值
+    if adaptive:
+        threshold = otsu_threshold_masked(lung_values, pbv_image.size - lung_index.size)
+        normal_threshold = threshold * 2.2   # 正常阈值为最优阈值的2.2倍
+        defect_threshold = threshold * 1.85  # 缺损阈值为最优阈值的1.85倍
+    else:
+        normal_threshold = 0.55
+        defect_threshold = 0.45
+    if verbose:
+        print(normal_threshold)
+        print(defect_threshold)
+
+    # 评估肺内每个像素的灌注状态
+    lung_classes = np.zeros(lung_index.size, dtype=np.uint8)
+    lung_classes[lung_values >= normal_threshold] = LABEL_NORMAL
+    lung_classes[(lung_values >= defect_threshold) & (lung_values < normal_threshold)] = LABEL_REDUCED
+    lung_classes[(lung_values < defect_threshold) & (lung_values > 0.0001)] = LABEL_DEFECT
+
+    # 左右肺 x 灌注状态一次bincount统计
+    counts = np.bincount(lung_sides * 4 + lung_classes, minlength=12).reshape(3, 4)
+    right_counts = counts[SIDE_RIGHT]
+    left_counts = counts[SIDE_LEFT]
+    return lung_classes, \
+        right_counts.sum(), right_counts[LABEL_NORMAL], right_counts[LABEL_DEFECT], right_counts[LABEL_REDUCED], \
+        left_counts.sum(), left_counts[LABEL_NORMAL], left_counts[LABEL_DEFECT], left_counts[LABEL_REDUCED]
+
+
+# 由掩码文件中的三个索引得到与lung_index对应的左右肺标签
+def lung_sides_from_index(lung_index, right_lung_index, left_lung_index):
+    lung_sides = np.zeros(lung_index.size, dtype=np.uint8)
+    lung_sides[np.searchsorted(lung_index, right_lung_index)] = SIDE_RIGHT
+    lung_sides[np.searchsorted(lung_index, left_lung_index)] = SIDE_LEFT
+    return lung_sides
+
+
+# 使用掩码文件中保存的掩码对PBV图像重新分级(例如阈值研究)，不需要重新分割
+def classify_from_mask_store(store, index, pbv_image, adaptive=False):
+    lung_index, right_lung_index, left_lung_index = store.indices(index)
+    lung_sides = lung_sides_from_index(lung_index, right_lung_index, left_lung_index)
+    return classify_lung_perfusion_index(pbv_image, lung_index, lung_sides, adaptive, verbose=False)
+
+
+# 分区定量: 头尾方向分为上、中、下三个区，每层切片再按到肺边界的距离分为中心区和外周区
+ZONE_NAMES = ['Upper', 'Middle', 'Lower']
+SHELL_NAMES = ['Central', 'Peripheral']
+
+
+# 肺内每个像素到肺边界的距离(mm)小于peripheral_mm时为外周区(1)，否则为中心区(0)
+def lung_shells(lung_mask, lung_index, pixel_spacing=(1.0, 1.0), peripheral_mm=20.0):
+    # 距离变换只在肺的外接矩形内计算(四周留1个像素的背景)
+    box = lung_bounding_box(lung_mask)
+    distance = distance_transform_edt(lung_mask[box], sampling=pixel_spacing)
+    rows, cols = np.divmod(lung_index, lung_mask.shape[1])
+    return (distance[rows - box[0].start, cols - box[1].start] < peripheral_mm).astype(np.uint8)
+
+
+# 一个切片的 左右肺 x 中心/外周 x 灌注状态 计数，只需一次bincount，返回形状为(2, 2, 4)
+def zonal_slice_counts(lung_sides, lung_shells, lung_classes):
+    keys = (lung_sides.astype(np.intp) * 2 + lung_shells) * 4 + lung_classes
+    return np.bincount(keys, minlength=24).reshape(3, 2, 4)[SIDE_RIGHT:]
+
+
+# 根据切片位置把有肺的切片分为上、中、下三个区(DICOM坐标z轴指向头侧)
+def slice_zones(positions, has_lung):
+    positions = np.asarray(positions, dtype=float)
+    zones = np.full(positions.shape, -1, dtype=np.intp)
+    if not np.any(has_lung):
+        return zones
+    top = positions[has_lung].max()
+    bottom = positions[has_lung].min()
+    extent = max(top - bottom, 1e-6)
+    zones[has_lung] = np.minimum((3 * (top - positions[has_lung]) / extent).astype(np.intp), 2)
+    return zones
+
+
+# 分区用的切片位置: 所有切片都有ImagePositionPatient时用z(mm)，否则都有InstanceNumber时按编号
+# (胸部CT一般从头侧开始编号，编号越大越靠下)，都没有时返回None(无法分区)
+def zonal_positions(z_positions, instance_numbers):
+    if all(z is not None for z in z_positions):
+        return list(z_positions)
+    if all(n is not None for n in instance_numbers):
+        return [-n for n in instance_numbers]
+    return None
+
+
+# 把每个切片的分区计数按区汇总为表格，每行为一个 区 x 中心/外周
+def zonal_table(slice_counts, positions):
+    '''
+        slice_counts: 每个切片zonal_slice_counts的结果，形状为(切片数, 2, 2, 4);
+        positions: 每个切片的位置(mm);
+    '''
+    import pandas as pd
+    slice_counts = np.asarray(slice_counts).reshape(-1, 2, 2, 4)
+    zones = slice_zones(positions, slice_counts.sum(axis=(1, 2, 3)) > 0)
+    zone_counts = np.zeros((3,) + slice_counts.shape[1:], dtype=np.int64)
+    np.add.at(zone_counts, zones[zones >= 0], slice_counts[zones >= 0])
+    rows = []
+    for z, zone in enumerate(ZONE_NAMES):
+        for k, shell in enumerate(SHELL_NAMES):
+            row = [zone, shell]
+            for side in (0, 1):
+                counts = zone_counts[z, side, k]
+                row += [counts.sum(), counts[LABEL_NORMAL], counts[LABEL_DEFECT], counts[LABEL_REDUCED]]
+            rows.append(row)
+    return pd.DataFrame(rows, columns=[
+        'Zone', 'Shell', 'Right_Lung', 'Right_Normal', 'Right_Defect', 'Right_Reduced',
+        'Left_Lung', 'Left_Normal', 'Left_Defect', 'Left_Reduced',
+    ])
+
+
+# 由标签图生成全肺、右肺和左肺的uint8彩色灌注图
+def perfusion_label_colors(lung_label, side_label):
+    lung_perfusion_color = PERFUSION_LUT[lung_label]
+    right_lung_perfusion_color = PERFUSION_LUT[np.where(side_label == SIDE_RIGHT, lung_label, LABEL_NONE)]
+    left_lung_perfusion_color = PERFUSION_LUT[np.where(side_label == SIDE_LEFT, lung_label, LABEL_NONE)]
+    return lung_perfusion_color, right_lung_perfusion_color, left_lung_perfusion_color
+
+
+# 每个切片在各阶段占用的内存(字节)估计: (队列中解码后的数据, 计算时的峰值, 队列中的计算结果)
+def estimate_slice_bytes(image_shape, lean=False):
+    pixels = image_shape[0] * image_shape[1]
+    decoded = 2 * 2 * pixels   # CT和PBV原始数据(16位)
+    if lean:
+        # 3个bool掩码 + 区域标记(int64) + 标签图 + 肺内float32值 + 肺内int32索引(肺按不超过一半的像素估计)
+        peak = decoded + pixels * (3 + 8 + 2 + 4) + pixels * 4 // 2
+        result = 2 * pixels
+    else:
+        # float64归一化图和3个灌注图 + 3个float64彩色图 + 掩码和临时bool数组
+        peak = decoded + pixels * (4 * 8 + 3 * 24 + 8 + 12)
+        result = pixels * (3 * 8 + 3 * 24)
+    return decoded, peak, result
+
+
+# 根据每个进程的内存预算选择计算线程数和队列长度
+def plan_memory_budget(memory_budget, image_shape, lean=False, compute_workers=1):
+    '''
+        memory_budget: 内存预算(字节);
+        返回 (compute_workers, queue_size)
+    '''
+    decoded, peak, result = estimate_slice_bytes(image_shape, lean)
+    # 计算线程至少保留一个，多余的线程在预算不足时减少
+    compute_workers = max(1, min(compute_workers, memory_budget // (peak + decoded + result)))
+    remaining = memory_budget - compute_workers * peak
+    queue_size = max(1, remaining // (decoded + result))
+    return int(compute_workers), int(queue_size)
+
+
 def run02_lung_perfusion():
+    import matplotlib.pyplot as plt
     ctname = "CT-0003-00055"
     pbvname = "PBV-0014-00055"
     ct_file = os.path.join(r'E:\cjfh\dectpe\threshold\verifythreshold2\healthy-case1', ctname + '.dcm')
@@ -177,81 +428,359 @@ def run02_lung_perfusion():
     plt.show()
 
 
-run02_lung_perfusion()
-
-
-# 列出目录中的所有dcm文件名
-def list_dcm_files(directory):
-    # 使用 glob 模块列出当前目录中的所有.dcm 文件
-    dcm_files = glob.glob(os.path.join(directory, 'CT', '*.dcm'))
-    # 过滤出文件（排除子目录），并获取文件名
-    dcm_file_names = [os.path.basename(file) for file in dcm_files if os.path.isfile(file)]
-    return dcm_file_names
 
-
-# 示例用法
-def batch_lung_perfusion(case_dirpath, case_id):
+# 流水线各阶段之间传递的结束标记
+_STOP = object()
+
+
+def _queue_put(q, item, abort):
+    # 带超时的put，出错时其它阶段不会因为队列已满而卡死
+    while not abort.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _queue_get(q, abort):
+    while not abort.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _STOP
+
+
+# 启动流水线的一个阶段: n_workers个线程从in_queue取数据，处理后放入out_queue
+def _start_stage(func, in_queue, out_queue, n_workers, abort, errors):
+    remaining = [n_workers]
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                item = _queue_get(in_queue, abort)
+                if item is _STOP:
+                    # 放回结束标记，通知同一阶段的其它线程
+                    _queue_put(in_queue, _STOP, abort)
+                    break
+                result = func(item)
+                if out_queue is not None and not _queue_put(out_queue, result, abort):
+                    break
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            # 本阶段最后一个线程结束时通知下游
+            if last and out_queue is not None:
+                _queue_put(out_queue, _STOP, abort)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(n_workers)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+# 依次启动各阶段并把tasks送入流水线，stages为[(func, n_workers), ...]，最后一个阶段没有输出
+def run_pipeline(tasks, stages, queue_size=8):
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    abort = threading.Event()
+    errors = []
+    threads = []
+    for i, (func, n_workers) in enumerate(stages):
+        out_queue = queues[i + 1] if i + 1 < len(stages) else None
+        threads += _start_stage(func, queues[i], out_queue, n_workers, abort, errors)
+    for task in tasks:
+        if not _queue_put(queues[0], task, abort):
+            break
+    _queue_put(queues[0], _STOP, abort)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+# 三联图保存，使用面向对象的Figure接口(pyplot不是线程安全的)
+def save_perfusion_figure(png_file, lung_perfusion_color, right_lung_perfusion_color, left_lung_perfusion_color):
+    from matplotlib.figure import Figure
+    fig = Figure()
+    axes = fig.subplots(1, 3)
+    images = [lung_perfusion_color, right_lung_perfusion_color, left_lung_perfusion_color]
+    titles = ['lung', 'right lung', 'left lung']
+    for ax, image, title in zip(axes, images, titles):
+        ax.imshow(image)
+        ax.axis('off')
+        ax.set_title(title)
+    fig.savefig(png_file)
+
+
+# 流水线方式批量处理一个患者: 读取线程解码DICOM，计算线程分割和分级，写入线程保存图像和表格
+# 各阶段之间使用有界队列，内存占用与病例大小无关，吞吐量接近最慢的阶段
+def batch_lung_perfusion(case_dirpath, case_id, adaptive=True, reader_workers=2, compute_workers=None,
+                         writer_workers=2, queue_size=8, lean=False, memory_budget=None, save_masks=False,
+                         result_dirpath=None, zonal=False, peripheral_mm=20.0, stats=False, progress=None,
+                         write_dicom=False, write_png=True, mask_provider=None, mask_cache=None):
+    '''
+        case_dirpath: 患者根目录;
+        case_id: 患者编号;
+        reader_workers/compute_workers/writer_workers: 各阶段线程数;
+        queue_size: 阶段之间队列的最大长度;
+        lean: 节省内存模式，使用float32和uint8标签图;
+        memory_budget: 每个进程的内存预算(字节)，设置后自动选择计算线程数和队列长度;
+        save_masks: 把每个切片的掩码压缩保存到 case_id.lmk 文件中;
+        result_dirpath: 结果输出根目录，默认为case_dirpath(图像保存在case_id/result中);
+        zonal: 同时按上中下区和中心/外周区定量，结果保存在表格的Zonal工作表中;
+        peripheral_mm: 距肺边界小于该距离(mm)的像素为外周区;
+        stats: 统计左右肺归一化PBV值的直方图，保存为 case_id_pbvhist.npz，用于队列阈值标定;
+        progress: 每个切片写入后调用 progress(dcm_file, counts)，在写入线程中执行;
+        write_dicom: 把灌注标签图和彩色图分别保存为一个多帧DICOM(RLE无损压缩);
+        write_png: 保存每个切片的三联PNG图;
+        mask_provider: 肺分割方法(maskprovider.MaskProvider)，默认为get_ct_mask的阈值分割且不使用缓存;
+        mask_cache: 掩码缓存(maskprovider.MaskCache)，指定mask_provider时默认不保留掩码(一次批处理中每个切片只分割一次);
+    '''
+    if compute_workers is None:
+        compute_workers = os.cpu_count() or 1
     dcm_files = list_dcm_files(os.path.join(case_dirpath, case_id))
-    dcm_file_list = []
-    right_lung_list = []
-    right_normal_list = []
-    right_defect_list = []
-    right_reduced_list = []
-    left_lung_list = []
-    left_normal_list = []
-    left_defect_list = []
-    left_reduced_list = []
-    # 创建pandas量化表格
-    for dcm_file in dcm_files:
+    # 没有切片时不输出表格，否则缺失的患者在汇总表中看起来像肺像素为0
+    if not dcm_files:
+        raise FileNotFoundError(f"No CT slices found in '{os.path.join(case_dirpath, case_id, 'CT')}'.")
+    if result_dirpath is None:
+        result_dirpath = case_dirpath
+        result_path = os.path.join(case_dirpath, case_id, 'result')
+    else:
+        result_path = os.path.join(result_dirpath, case_id)
+    os.makedirs(result_path, exist_ok=True)
+    rows = [None] * len(dcm_files)
+    positions = [None] * len(dcm_files)
+    zonal_counts = [None] * len(dcm_files)
+    histogram = pbvstats.PerfusionHistogram() if stats else None
+    image_positions = [None] * len(dcm_files)
+    instance_numbers = [None] * len(dcm_files)
+    label_frames = [None] * len(dcm_files)
+    color_frames = [None] * len(dcm_files)
+    # 分区定量、直方图统计、DICOM输出和节省内存模式都使用标签图
+    use_labels = lean or zonal or stats or write_dicom
+    mask_writer = None
+    # 调用者没有传入缓存时不在内存中保留掩码，不占用内存预算之外的内存
+    if mask_provider is not None and mask_cache is None:
+        mask_cache = maskprovider.MaskCache(memory_items=0)
+    if write_dicom:
+        import dicomout
+    if (memory_budget is not None or save_masks or write_dicom) and dcm_files:
+        header = pydicom.dcmread(os.path.join(case_dirpath, case_id, 'CT', dcm_files[0]), stop_before_pixels=True)
+        image_shape = (header.Rows, header.Columns)
+        if memory_budget is not None:
+            compute_workers, queue_size = plan_memory_budget(memory_budget, image_shape, lean, compute_workers)
+        if save_masks:
+            mask_writer = maskstore.MaskStoreWriter(os.path.join(result_dirpath, case_id + '.lmk'), image_shape,
+                                                    len(dcm_files))
+
+    def read(index):
+        dcm_file = dcm_files[index]
         ct_file = os.path.join(case_dirpath, case_id, 'CT', dcm_file)
-        pbv_file = os.path.join(case_dirpath, case_id, 'PBV', dcm_file)
-        # 分割肺部区域并绘制轮廓线
-        lung_mask, right_lung_mask, left_lung_mask = get_ct_mask(ct_file)
-        adaptive = True
-        lung_perfusion, lung_perfusion_color, right_lung_perfusion, right_lung_perfusion_color, left_lung_perfusion, left_lung_perfusion_color,\
-            right_lung_count, right_normal_count, right_defect_count, right_reduced_count, left_lung_count, left_nornal_count, left_defect_count, left_reduced_count = extract_lung_perfusion(pbv_file, lung_mask, right_lung_mask, left_lung_mask, adaptive)
-        # 添加一个患者数据
-        dcm_file_list.append(dcm_file)
-        right_lung_list.append(right_lung_count)
-        right_normal_list.append(right_normal_count)
-        right_defect_list.append(right_defect_count)
-        right_reduced_list.append(right_reduced_count)
-        left_lung_list.append(left_lung_count)
-        left_normal_list.append(left_nornal_count)
-        left_defect_list.append(left_defect_count)
-        left_reduced_list.append(left_reduced_count)
-
-        # 显示结果
-        plt.subplot(1, 3, 1)
-        plt.imshow(lung_perfusion_color)
-        plt.axis('off')
-        plt.title('lung')
-        plt.subplot(1, 3, 2)
-        plt.imshow(right_lung_perfusion_color)
-        plt.axis('off')
-        plt.title('right lung')
-        plt.subplot(1, 3, 3)
-        plt.imshow(left_lung_perfusion_color)
-        plt.axis('off')
-        plt.title('left lung')
-        plt.savefig(os.path.join(case_dirpath, case_id, 'result', dcm_file.split()[0] + '.png'))
-        plt.close()
+        # 使用掩码缓存时需要CT文件的内容计算缓存键，只读取一次
+        ct_bytes = None
+        if mask_provider is not None:
+            with open(ct_file, 'rb') as f:
+                ct_bytes = f.read()
+        ct_data = pydicom.dcmread(ct_file if ct_bytes is None else io.BytesIO(ct_bytes))
+        pbv_image = pydicom.dcmread(os.path.join(case_dirpath, case_id, 'PBV', dcm_file)).pixel_array
+        if 'ImagePositionPatient' in ct_data:
+            positions[index] = float(ct_data.ImagePositionPatient[2])
+            image_positions[index] = [float(x) for x in ct_data.ImagePositionPatient]
+        if 'InstanceNumber' in ct_data:
+            instance_numbers[index] = int(ct_data.InstanceNumber)
+        pixel_spacing = tuple(float(x) for x in ct_data.PixelSpacing) if 'PixelSpacing' in ct_data else (1.0, 1.0)
+        orientation = ct_data.get('ImageOrientationPatient')
+        return index, ct_data.pixel_array, pbv_image, pixel_spacing, (ct_bytes, orientation)
+
+    def compute(item):
+        index, ct_image, pbv_image, pixel_spacing, (ct_bytes, orientation) = item
+        # 分割肺部区域并评估灌注
+        # 左右肺与使用mask_provider时一样按解剖位置分配，而不是按面积大小
+        if mask_provider is None:
+            lung_mask, right_lung_mask, left_lung_mask = maskprovider.assign_sides_by_anatomy(
+                *get_ct_mask_from_image(ct_image), orientation)
+        else:
+            lung_mask, right_lung_mask, left_lung_mask = mask_cache.masks(
+                mask_provider, os.path.join(case_dirpath, case_id, 'CT', dcm_files[index]), ct_bytes, ct_image,
+                orientation)
+        # 掩码在计算线程中压缩，写入线程只保存压缩后的数据
+        if mask_writer is not None:
+            mask_writer.add_encoded(index, maskstore.encode_slice(lung_mask, right_lung_mask, left_lung_mask),
+                                    dcm_files[index])
+        if use_labels:
+            lung_index = lung_pixel_index(lung_mask)
+            side_label = side_label_from_masks(right_lung_mask, left_lung_mask)
+            lung_sides = side_label.ravel()[lung_index]
+            lung_classes, *counts = classify_lung_perfusion_index(pbv_image, lung_index, lung_sides, adaptive,
+                                                                  verbose=False, histogram=histogram)
+            # 分区计数复用同一次分级的结果
+            if zonal:
+                shells = lung_shells(lung_mask, lung_index, pixel_spacing, peripheral_mm)
+                zonal_counts[index] = zonal_slice_counts(lung_sides, shells, lung_classes)
+            lung_label = np.zeros(pbv_image.shape, dtype=np.uint8)
+            lung_label.ravel()[lung_index] = lung_classes
+            # 只把外接矩形内的标签图传给写入线程
+            box = lung_bounding_box(lung_mask)
+            return index, (pbv_image.shape, box, lung_label[box].copy(), side_label[box].copy()), counts
+        lung_perfusion, lung_perfusion_color, right_lung_perfusion, right_lung_perfusion_color, \
+            left_lung_perfusion, left_lung_perfusion_color, *counts = classify_lung_perfusion(
+                pbv_image, lung_mask, right_lung_mask, left_lung_mask, adaptive, verbose=False)
+        return index, (lung_perfusion_color, right_lung_perfusion_color, left_lung_perfusion_color), counts
+
+    def write(item):
+        index, images, counts = item
+        dcm_file = dcm_files[index]
+        # 使用标签图时彩色图只在写入时由外接矩形内的标签图生成，再放回整幅图像
+        if use_labels:
+            shape, box, lung_label, side_label = images
+            colors = [paste_bounding_box(color, shape, box) for color in perfusion_label_colors(lung_label, side_label)]
+        else:
+            colors = images
+        if write_png:
+            save_perfusion_figure(os.path.join(result_path, dcm_file.split()[0] + '.png'), *colors)
+        # DICOM的每一帧在写入线程中压缩，不保留整个体数据
+        if write_dicom:
+            label_frames[index] = dicomout.encode_label_frame(paste_bounding_box(lung_label, shape, box))
+            color_frames[index] = dicomout.encode_color_frame(colors[0])
+        # 添加一个切片数据，按原始顺序保存
+        rows[index] = [dcm_file] + counts
+        if progress is not None:
+            progress(dcm_file, counts)
+
+    run_pipeline(range(len(dcm_files)), [(read, reader_workers), (compute, compute_workers), (write, writer_workers)],
+                 queue_size)
+
+    if mask_writer is not None:
+        mask_writer.close()
+    if histogram is not None:
+        histogram.save(os.path.join(result_dirpath, case_id + '_pbvhist.npz'))
+    if write_dicom and dcm_files:
+        # 按InstanceNumber(没有时按文件名)排列各帧
+        order = sorted(range(len(dcm_files)), key=lambda i: (instance_numbers[i] is None, instance_numbers[i] or 0,
+                                                              dcm_files[i]))
+        positions_in_order = [image_positions[i] for i in order]
+        dicomout.write_multiframe_dicom(os.path.join(result_dirpath, case_id + '_perfusion_label.dcm'),
+                                        [label_frames[i] for i in order], image_shape, header, positions_in_order,
+                                        color=False, series_description='Lung perfusion label map')
+        dicomout.write_multiframe_dicom(os.path.join(result_dirpath, case_id + '_perfusion_color.dcm'),
+                                        [color_frames[i] for i in order], image_shape, header, positions_in_order,
+                                        color=True, series_description='Lung perfusion color map', series_number=901)
 
     # 量化结果保存为Excel文件
-    df = pd.DataFrame({
-        'File_Name': dcm_file_list,
-        'Right_Lung': right_lung_list,
-        'Right_Normal': right_normal_list,
-        'Right_Defect': right_defect_list,
-        'Right_Reduced': right_reduced_list,
-        'Left_Lung': left_lung_list,
-        'Left_Normal': left_normal_list,
-        'Left_Defect': left_defect_list,
-        'Left_Reduced': left_reduced_list,
-    })
-
-    # 将DataFrame保存为Excel文件
-    df.to_excel(os.path.join(case_dirpath, case_id + '.xlsx'), index=False)
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=[
+        'File_Name', 'Right_Lung', 'Right_Normal', 'Right_Defect', 'Right_Reduced',
+        'Left_Lung', 'Left_Normal', 'Left_Defect', 'Left_Reduced',
+    ])
+
+    # 将DataFrame保存为Excel文件，分区定量结果保存在第二个工作表中
+    if zonal:
+        positions = zonal_positions(positions, instance_numbers)
+        if positions is None:
+            print(f"{case_id}: not every slice has ImagePositionPatient or InstanceNumber, Zonal sheet skipped.")
+    if zonal and positions is not None:
+        with pd.ExcelWriter(os.path.join(result_dirpath, case_id + '.xlsx'), engine='openpyxl') as writer:
+            df.to_excel(writer, sheet_name='Sheet1', index=False)
+            zonal_table(zonal_counts, positions).to_excel(writer, sheet_name='Zonal', index=False)
+    else:
+        df.to_excel(os.path.join(result_dirpath, case_id + '.xlsx'), index=False)
+
+
+# 层内按factor x factor块取平均进行降采样
+def downsample_image(image, factor):
+    if factor <= 1:
+        return image
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:height * factor, :width * factor].reshape(height, factor, width, factor)
+    return blocks.mean(axis=(1, 3)).round().astype(image.dtype)
+
+
+# 层内每factor x factor块取一个像素(不平均)，大小与downsample_image相同
+def subsample_image(image, factor):
+    if factor <= 1:
+        return image
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    return image[:height * factor:factor, :width * factor:factor]
+
+
+# 只统计不输出图像的快速定量，返回整个患者的8个计数(已按降采样比例换算为原始分辨率的像素数)
+def quantify_lung_perfusion(case_dirpath, case_id, slice_step=1, factor=1, adaptive=True, reader_workers=2,
+                            compute_workers=None, queue_size=8):
+    '''
+        slice_step: 每slice_step层取一层;
+        factor: 层内降采样倍数(1/2/4);
+    '''
+    if compute_workers is None:
+        compute_workers = os.cpu_count() or 1
+    dcm_files = sorted(list_dcm_files(os.path.join(case_dirpath, case_id)))[::slice_step]
+    totals = np.zeros(8, dtype=np.int64)
+    lock = threading.Lock()
+
+    def read(dcm_file):
+        ct_data = pydicom.dcmread(os.path.join(case_dirpath, case_id, 'CT', dcm_file))
+        ct_image = ct_data.pixel_array
+        pbv_image = pydicom.dcmread(os.path.join(case_dirpath, case_id, 'PBV', dcm_file)).pixel_array
+        # CT平均降采样用于分割；PBV取样不平均，并按原始图像的范围归一化，否则平滑改变阈值和分级
+        value_range = (pbv_image.min(), pbv_image.max())
+        return (downsample_image(ct_image, factor), subsample_image(pbv_image, factor), value_range,
+                ct_data.get('ImageOrientationPatient'))
+
+    def compute(item):
+        ct_image, pbv_image, value_range, orientation = item
+        lung_mask, right_lung_mask, left_lung_mask = maskprovider.assign_sides_by_anatomy(
+            *get_ct_mask_from_image(ct_image), orientation)
+        lung_index = lung_pixel_index(lung_mask)
+        lung_sides = side_label_from_masks(right_lung_mask, left_lung_mask).ravel()[lung_index]
+        lung_classes, *counts = classify_lung_perfusion_index(pbv_image, lung_index, lung_sides, adaptive,
+                                                              verbose=False, value_range=value_range)
+        with lock:
+            totals[:] += counts
+
+    run_pipeline(dcm_files, [(read, reader_workers), (compute, compute_workers)], queue_size)
+    return totals * slice_step * factor * factor
+
+
+# 由8个计数计算左右肺正常、缺损和减低的百分比
+def perfusion_percent_from_counts(counts):
+    percents = []
+    for lung, normal, defect, reduced in (counts[:4], counts[4:]):
+        lung = max(lung, 1)
+        percents += [round(normal / lung * 100.00, 2), round(defect / lung * 100.00, 2),
+                     round(reduced / lung * 100.00, 2)]
+    return percents
+
+
+TRIAGE_COLUMNS = [
+    'Right_Normal_Percent', 'Right_Defect_Percent', 'Right_Reduced_Percent',
+    'Left_Normal_Percent', 'Left_Defect_Percent', 'Left_Reduced_Percent',
+]
+
+
+# 低分辨率快速筛查: 每slice_step层取一层，层内factor倍降采样，分割和分级与完整流程相同
+def triage_lung_perfusion(case_dirpath, case_ids, slice_step=4, factor=2, adaptive=True, compute_workers=None):
+    import pandas as pd
+    rows = []
+    for case_id in case_ids:
+        counts = quantify_lung_perfusion(case_dirpath, case_id, slice_step, factor, adaptive,
+                                         compute_workers=compute_workers)
+        rows.append([case_id] + perfusion_percent_from_counts(counts))
+    return pd.DataFrame(rows, columns=['case'] + TRIAGE_COLUMNS)
+
+
+# 在基准病例上比较快速筛查与完整分辨率的百分比，返回每个病例的绝对误差(百分点)
+def triage_error_estimate(case_dirpath, case_ids, slice_step=4, factor=2, adaptive=True, compute_workers=None):
+    triage = triage_lung_perfusion(case_dirpath, case_ids, slice_step, factor, adaptive, compute_workers)
+    full = triage_lung_perfusion(case_dirpath, case_ids, 1, 1, adaptive, compute_workers)
+    error = triage.copy()
+    error[TRIAGE_COLUMNS] = (triage[TRIAGE_COLUMNS] - full[TRIAGE_COLUMNS]).abs()
+    return error
 
 
 def run03_batch_lung_perfusion():
@@ -261,3 +790,7 @@ def run03_batch_lung_perfusion():
     cases = ['case18', 'case35']
     for case in cases:
         batch_lung_perfusion(case_dirpath, case)
+
+
+if __name__ == '__main__':
+    run02_lung_perfusion()
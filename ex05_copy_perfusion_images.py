@@ -11,6 +11,9 @@
 
 import os
 import shutil
+import hashlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from workbase.dectpe.core.alpha import perfusion_image_list
 
 
@@ -30,3 +33,133 @@ def run_copy_perfusion_images():
                 os.makedirs(destination_path)
             shutil.copy(source_path, destination_path)
 
+
+# 计算文件的哈希值
+def file_digest(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# 判断目标文件是否已经是最新的
+def image_is_current(source_path, destination_path, use_hash=False, use_hardlink=False):
+    '''
+        use_hash: False时比较大小和修改时间，True时比较文件内容的哈希值
+        use_hardlink: 使用硬链接时，链接到源的目标总是最新的；不使用时这样的目标需要重新复制
+    '''
+    if not os.path.exists(destination_path):
+        return False
+    # 硬链接的目标与源是同一个文件，源被原地重新生成后目标随之改变
+    if os.path.samefile(source_path, destination_path):
+        return use_hardlink
+    source_stat = os.stat(source_path)
+    destination_stat = os.stat(destination_path)
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+    if use_hash:
+        return file_digest(source_path) == file_digest(destination_path)
+    # FAT/网络盘的时间精度为2秒
+    return abs(source_stat.st_mtime - destination_stat.st_mtime) <= 2
+
+
+# 同步单个文件：复制(保留修改时间)，use_hardlink时同一文件系统上使用硬链接
+# 硬链接的目标会随结果重新生成而改变，发送给医生的目录不要使用
+def sync_image(source_path, destination_path, use_hash=False, use_hardlink=False):
+    if image_is_current(source_path, destination_path, use_hash, use_hardlink):
+        return 'skipped'
+    # 先写临时文件再替换，复制失败时医生手里的旧文件仍然保留
+    tmp_path = destination_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    if use_hardlink and os.stat(source_path).st_dev == os.stat(os.path.dirname(destination_path)).st_dev:
+        try:
+            os.link(source_path, tmp_path)
+            os.replace(tmp_path, destination_path)
+            return 'linked'
+        except OSError:
+            pass
+    try:
+        shutil.copy2(source_path, tmp_path)
+        os.replace(tmp_path, destination_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return 'copied'
+
+
+# 把一个患者的灌注图像打包为一个zip文件，PNG已经压缩过，因此只存储不再压缩
+def zip_case_images(case_destination_path, names, zip_path):
+    tmp_path = zip_path + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for name in sorted(names):
+            zf.write(os.path.join(case_destination_path, name), arcname=name)
+    os.replace(tmp_path, zip_path)
+
+
+# zip文件比其中所有图像都新时不需要重新打包
+def zip_is_current(case_destination_path, names, zip_path):
+    if not os.path.exists(zip_path):
+        return False
+    zip_mtime = os.stat(zip_path).st_mtime
+    return all(os.stat(os.path.join(case_destination_path, name)).st_mtime <= zip_mtime for name in names)
+
+
+# 增量并行同步灌注图像，只复制新增或变化的文件
+def sync_perfusion_images(case_dirpath, case_list, destination_dirpath, result_dirname="result_r231",
+                          workers=8, use_hash=False, use_hardlink=False, make_zip=False):
+    '''
+        case_dirpath: 所有患者的根目录;
+        case_list: 患者编号列表;
+        destination_dirpath: 发送给医生的目标目录;
+        workers: 复制线程数;
+        use_hash: 使用哈希值判断文件是否变化(较慢但更可靠);
+        use_hardlink: 源和目标在同一文件系统时使用硬链接(目标会随源一起改变，只用于本地临时目录);
+        make_zip: 每个患者额外打包为一个zip文件;
+        返回每种操作的文件数量
+    '''
+    stats = {'copied': 0, 'linked': 0, 'skipped': 0, 'zipped': 0}
+
+    def list_case(caseid):
+        result_path = os.path.join(case_dirpath, caseid, result_dirname)
+        if not os.path.isdir(result_path):
+            print(f"Result folder '{result_path}' not found.")
+            return caseid, []
+        os.makedirs(os.path.join(destination_dirpath, caseid), exist_ok=True)
+        return caseid, perfusion_image_list(result_path)
+
+    def sync_one(task):
+        caseid, name = task
+        source_path = os.path.join(case_dirpath, caseid, result_dirname, name)
+        destination_path = os.path.join(destination_dirpath, caseid, name)
+        return caseid, sync_image(source_path, destination_path, use_hash, use_hardlink)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # 列出每个患者的图像(网络盘上listdir也较慢，因此同样并行)
+        case_names = dict(pool.map(list_case, case_list))
+        tasks = [(caseid, name) for caseid in case_list for name in case_names[caseid]]
+        for caseid, action in pool.map(sync_one, tasks):
+            stats[action] += 1
+
+        if make_zip:
+            zip_jobs = []
+            for caseid in case_list:
+                zip_path = os.path.join(destination_dirpath, caseid + '.zip')
+                case_destination_path = os.path.join(destination_dirpath, caseid)
+                # 按zip和图像的修改时间判断，上次打包中断或图像被替换后也会重新打包
+                if case_names[caseid] and not zip_is_current(case_destination_path, case_names[caseid], zip_path):
+                    zip_jobs.append(pool.submit(zip_case_images, case_destination_path, case_names[caseid],
+                                                zip_path))
+            for job in zip_jobs:
+                job.result()
+                stats['zipped'] += 1
+    return stats
+
+
+def run_sync_perfusion_images():
+    case_dirpath = r'E:\cjfh\dectpe\raw\allcases'
+    case_list = [f'case{str(i).zfill(3)}' for i in range(101, 245)]
+    stats = sync_perfusion_images(case_dirpath, case_list, r"D:\download\allcases_perfusion", make_zip=True)
+    print(stats)
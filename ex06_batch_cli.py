@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+#
+# Title: 批量灌注分析的命令行入口，支持多节点分片运行和结果合并
+# Author:
+# Refer:
+# Repo:
+# Date: 2024-12-xx
+#
+# 用法:
+#   python ex06_batch_cli.py run --input E:\cjfh\dectpe\raw\allcases --output E:\cjfh\dectpe\result \
+#       --range 1:244 --workers 8 --shard 0/4
+#   python ex06_batch_cli.py merge --output E:\cjfh\dectpe\result --table allcases_stat.xlsx
+#   python ex06_batch_cli.py compare --input E:\cjfh\dectpe\raw\allcases --output E:\cjfh\dectpe\result \
+#       --providers threshold watershed resunet --mask-cache E:\cjfh\dectpe\maskcache
+#
+
+
+import os
+import sys
+import glob
+import json
+import fnmatch
+import argparse
+from dataset import sum_columns, list_dcm_files
+from pbvstats import merge_histograms, threshold_summary
+# pandas和ex03(scikit-image、matplotlib等)导入较慢，只在需要的命令中导入
+
+
+# 汇总表中需要累加的列
+PARAM_NAMES = [
+    'Right_Lung', 'Right_Normal', 'Right_Defect', 'Right_Reduced',
+    'Left_Lung', 'Left_Normal', 'Left_Defect', 'Left_Reduced'
+]
+
+
+# 解析 512M / 2G 这样的内存大小
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+# 解析 i/N 形式的分片参数，i从0开始
+def parse_shard(text):
+    index, count = (int(x) for x in text.split('/'))
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard '{text}', expected i/N with 0 <= i < N")
+    return index, count
+
+
+# 根据 glob/列表文件/编号范围 选择患者，都未指定时选择所有含CT目录的患者
+def select_cases(input_dirpath, pattern=None, list_file=None, case_range=None, case_format='case{:03d}'):
+    if list_file is not None:
+        with open(list_file, encoding='utf-8') as f:
+            cases = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    elif case_range is not None:
+        start, end = (int(x) for x in case_range.split(':'))
+        cases = [case_format.format(i) for i in range(start, end + 1)]
+    else:
+        cases = sorted(name for name in os.listdir(input_dirpath)
+                       if os.path.isdir(os.path.join(input_dirpath, name, 'CT')))
+        if pattern is not None:
+            cases = [name for name in cases if fnmatch.fnmatch(name, pattern)]
+    return cases
+
+
+# 检查患者目录，--list/--range指定的患者可能不存在，没有CT目录的患者不处理
+def check_cases(input_dirpath, cases, report=True):
+    present = [case for case in cases if os.path.isdir(os.path.join(input_dirpath, case, 'CT'))]
+    missing = [case for case in cases if case not in present]
+    if missing and report:
+        print(f"No CT folder for {len(missing)} cases: {', '.join(missing)}")
+    return present, missing
+
+
+# 由命令行参数创建分割方法和掩码缓存
+def make_mask_provider(name, args):
+    import maskprovider
+    if name == 'resunet':
+        return maskprovider.get_provider(name, mask_dirname=args.mask_dirname)
+    return maskprovider.get_provider(name)
+
+
+# 一次运行中每个切片只分割一次，内存中不保留掩码；指定--mask-cache时保存到磁盘供以后的运行使用
+def make_mask_cache(args):
+    import maskprovider
+    return maskprovider.MaskCache(args.mask_cache, memory_items=0)
+
+
+# 按切片数把患者均衡地分到N个分片，结果只与患者和切片数有关，各节点独立计算得到相同的划分
+def shard_cases(input_dirpath, cases, shard_count):
+    slice_counts = {case: len(list_dcm_files(os.path.join(input_dirpath, case))) for case in cases}
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    # 切片数多的患者优先分配给当前负载最小的分片
+    for case in sorted(cases, key=lambda c: (-slice_counts[c], c)):
+        i = min(range(shard_count), key=lambda k: (loads[k], k))
+        shards[i].append(case)
+        loads[i] += slice_counts[case]
+    return [sorted(shard) for shard in shards], loads
+
+
+def run_command(args):
+    from ex03_mask_perfusion import batch_lung_perfusion
+    shard_index, shard_count = args.shard
+    # 不存在的患者不属于任何分片，只由分片0报告，其他分片的退出码只反映自己的患者
+    cases, missing = check_cases(args.input, select_cases(args.input, args.glob, args.list, args.range,
+                                                          args.case_format), report=shard_index == 0)
+    if shard_index != 0:
+        missing = []
+    shards, loads = shard_cases(args.input, cases, shard_count)
+    cases = shards[shard_index]
+    print(f"shard {shard_index}/{shard_count}: {len(cases)} cases, {loads[shard_index]} slices")
+    os.makedirs(args.output, exist_ok=True)
+    memory_budget = parse_size(args.memory_budget) if args.memory_budget else None
+    mask_provider = make_mask_provider(args.mask_provider, args) if args.mask_provider else None
+    mask_cache = make_mask_cache(args) if mask_provider is not None else None
+    done = []
+    for case in cases:
+        if args.skip_existing and os.path.exists(os.path.join(args.output, case + '.xlsx')):
+            print(f"{case}: skipped")
+            done.append(case)
+            continue
+        try:
+            batch_lung_perfusion(args.input, case, adaptive=not args.fixed_threshold, compute_workers=args.workers,
+                                 lean=args.lean, memory_budget=memory_budget, save_masks=args.save_masks,
+                                 result_dirpath=args.output, zonal=args.zonal, stats=args.stats,
+                                 write_dicom=args.dicom, write_png=not args.no_png, mask_provider=mask_provider,
+                                 mask_cache=mask_cache)
+        except FileNotFoundError as e:
+            # CT目录为空
+            print(f"{case}: {e}")
+            missing.append(case)
+            continue
+        done.append(case)
+        print(f"{case}: done")
+    # 记录本分片完成的患者，合并时检查是否有遗漏
+    manifest = os.path.join(args.output, f'shard-{shard_index}-of-{shard_count}.json')
+    with open(manifest, 'w', encoding='utf-8') as f:
+        json.dump({'cases': cases, 'done': done, 'missing': missing}, f, indent=1)
+    return 1 if missing else 0
+
+
+# 把各分片输出的每个患者的表格汇总为一个队列表格
+def merge_command(args):
+    import pandas as pd
+    if args.glob:
+        # 输出目录中还有汇总表、比较表和筛查表，汇总表直接排除，其他表格在下面按列检查
+        cases = sorted(os.path.basename(path)[:-len('.xlsx')]
+                       for path in glob.glob(os.path.join(args.output, args.glob + '.xlsx'))
+                       if os.path.basename(path) != os.path.basename(args.table))
+    elif args.list or args.range:
+        cases = select_cases(args.output, list_file=args.list, case_range=args.range, case_format=args.case_format)
+    else:
+        cases = []
+        for manifest in sorted(glob.glob(os.path.join(args.output, 'shard-*-of-*.json'))):
+            with open(manifest, encoding='utf-8') as f:
+                manifest = json.load(f)
+            # 输入中不存在的患者也作为缺失结果报告
+            cases.extend(manifest['cases'] + manifest.get('missing', []))
+        cases = sorted(set(cases))
+    if not cases:
+        print(f"No cases to merge in {args.output}.")
+        return 1
+    row_list = []
+    missing = []
+    for case in cases:
+        case_filepath = os.path.join(args.output, case + '.xlsx')
+        if not os.path.exists(case_filepath):
+            missing.append(case)
+            continue
+        case_df = pd.read_excel(case_filepath)
+        # 只汇总每个患者的逐切片表格
+        if 'File_Name' not in case_df.columns:
+            print(f"{case}: not a per-case table, skipped")
+            continue
+        sum_result = sum_columns(case_df, PARAM_NAMES)
+        row_list.append([case] + list(sum_result.values()))
+    if missing:
+        print(f"Missing results for {len(missing)} cases: {', '.join(missing)}")
+    df = pd.DataFrame(row_list, columns=['case'] + PARAM_NAMES)
+    table = args.table if os.path.isabs(args.table) else os.path.join(args.output, args.table)
+    df.to_excel(table, index=False)
+    print(f"Excel file created at {table}")
+    return 1 if missing and not args.allow_missing else 0
+
+
+# 合并所有患者的PBV直方图，输出队列的分位数和Otsu阈值
+def thresholds_command(args):
+    save_path = args.save if os.path.isabs(args.save) else os.path.join(args.output, args.save)
+    # 队列直方图不能再被当作患者合并进来(包括旧版本默认保存的cohort_pbvhist.npz)
+    excluded = {os.path.abspath(save_path), os.path.abspath(os.path.join(args.output, 'cohort_pbvhist.npz'))}
+    paths = sorted(path for path in glob.glob(os.path.join(args.output, '*_pbvhist.npz'))
+                   if os.path.abspath(path) not in excluded)
+    if not paths:
+        print(f"No PBV histograms found in {args.output}, run with --stats first.")
+        return 1
+    cohort = merge_histograms(paths)
+    cohort.save(save_path)
+    print(f"{len(paths)} cases merged into {save_path}")
+    print(json.dumps(threshold_summary(cohort), indent=1))
+    return 0
+
+
+# 逐切片比较不同分割方法的掩码(Dice)，掩码通过缓存与run共用
+def compare_command(args):
+    import pandas as pd
+    from maskprovider import compare_mask_providers
+    cases, _ = check_cases(args.input, select_cases(args.input, args.glob, args.list, args.range, args.case_format))
+    os.makedirs(args.output, exist_ok=True)
+    providers = [make_mask_provider(name, args) for name in args.providers]
+    cache = make_mask_cache(args)
+    tables = []
+    for case in cases:
+        ct_files = [os.path.join(args.input, case, 'CT', dcm_file)
+                    for dcm_file in list_dcm_files(os.path.join(args.input, case))]
+        df = compare_mask_providers(ct_files, providers, cache)
+        df.insert(0, 'case', case)
+        tables.append(df)
+        print(f"{case}: {len(ct_files)} slices compared")
+    df = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    table = args.table if os.path.isabs(args.table) else os.path.join(args.output, args.table)
+    with pd.ExcelWriter(table, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Slices', index=False)
+        if tables:
+            df.groupby(['case', 'Provider_A', 'Provider_B'], as_index=False).mean(numeric_only=True).to_excel(
+                writer, sheet_name='Cases', index=False)
+    print(f"Excel file created at {table}")
+    return 0
+
+
+# 新病例的低分辨率快速筛查，可选在基准病例上估计与完整分辨率的误差
+def triage_command(args):
+    import pandas as pd
+    from ex03_mask_perfusion import triage_lung_perfusion, triage_error_estimate
+    cases, _ = check_cases(args.input, select_cases(args.input, args.glob, args.list, args.range, args.case_format))
+    os.makedirs(args.output, exist_ok=True)
+    adaptive = not args.fixed_threshold
+    df = triage_lung_perfusion(args.input, cases, args.step, args.factor, adaptive, args.workers)
+    table = os.path.join(args.output, f'triage_step{args.step}_x{args.factor}.xlsx')
+    with pd.ExcelWriter(table, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Triage', index=False)
+        if args.benchmark:
+            error = triage_error_estimate(args.input, args.benchmark, args.step, args.factor, adaptive, args.workers)
+            error.to_excel(writer, sheet_name='Error', index=False)
+            print('Absolute error against full resolution (percentage points):')
+            print(error.drop(columns='case').agg(['mean', 'max']).round(2).to_string())
+    print(f"Excel file created at {table}")
+    return 0
+
+
+def add_case_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--glob', help="case folder name pattern, e.g. 'case1*'")
+    group.add_argument('--list', help='text file with one case id per line')
+    group.add_argument('--range', help='case number range START:END (inclusive)')
+    parser.add_argument('--case-format', default='case{:03d}', help='case id format used with --range')
+
+
+def add_mask_arguments(parser):
+    parser.add_argument('--mask-dirname', default='MASK', help='per-case folder with external (resunet) masks')
+    parser.add_argument('--mask-cache', help='folder of the content-addressed mask cache')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Batch DECT lung perfusion quantification.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='process cases of one shard')
+    run_parser.add_argument('--input', required=True, help='root folder with case/CT and case/PBV')
+    run_parser.add_argument('--output', required=True, help='root folder for per-case tables and images')
+    add_case_arguments(run_parser)
+    run_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='compute threads per case')
+    run_parser.add_argument('--shard', type=parse_shard, default=(0, 1), help='process shard i of N (0-based)')
+    run_parser.add_argument('--fixed-threshold', action='store_true', help='use 0.55/0.45 instead of Otsu')
+    run_parser.add_argument('--lean', action='store_true', help='memory-lean float32/uint8 mode')
+    run_parser.add_argument('--memory-budget', help='per-worker memory budget, e.g. 2G')
+    run_parser.add_argument('--save-masks', action='store_true', help='store compressed lung masks per case')
+    run_parser.add_argument('--zonal', action='store_true', help='add upper/middle/lower x central/peripheral counts')
+    run_parser.add_argument('--stats', action='store_true', help='save per-case normalized PBV histograms')
+    run_parser.add_argument('--dicom', action='store_true', help='write label and color maps as multi-frame DICOM')
+    run_parser.add_argument('--no-png', action='store_true', help='do not write per-slice PNG figures')
+    run_parser.add_argument('--mask-provider', choices=['threshold', 'watershed', 'resunet'],
+                            help='lung segmentation method, masks are cached (default: threshold, no cache)')
+    add_mask_arguments(run_parser)
+    run_parser.add_argument('--skip-existing', action='store_true', help='skip cases whose table already exists')
+    run_parser.set_defaults(func=run_command)
+
+    merge_parser = subparsers.add_parser('merge', help='merge per-case tables into the cohort table')
+    merge_parser.add_argument('--output', required=True, help='root folder given to run')
+    add_case_arguments(merge_parser)
+    merge_parser.add_argument('--table', default='allcases_stat.xlsx', help='cohort table file name')
+    merge_parser.add_argument('--allow-missing', action='store_true', help='exit 0 even if cases are missing')
+    merge_parser.set_defaults(func=merge_command)
+
+    triage_parser = subparsers.add_parser('triage', help='fast low-resolution perfusion estimate')
+    triage_parser.add_argument('--input', required=True, help='root folder with case/CT and case/PBV')
+    triage_parser.add_argument('--output', required=True, help='folder for the triage table')
+    add_case_arguments(triage_parser)
+    triage_parser.add_argument('--step', type=int, default=4, help='use every k-th slice')
+    triage_parser.add_argument('--factor', type=int, default=2, choices=[1, 2, 4], help='in-plane downsampling')
+    triage_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='compute threads per case')
+    triage_parser.add_argument('--fixed-threshold', action='store_true', help='use 0.55/0.45 instead of Otsu')
+    triage_parser.add_argument('--benchmark', nargs='+', help='phantom/benchmark cases for the error estimate')
+    triage_parser.set_defaults(func=triage_command)
+
+    compare_parser = subparsers.add_parser('compare', help='Dice between lung segmentation methods')
+    compare_parser.add_argument('--input', required=True, help='root folder with case/CT')
+    compare_parser.add_argument('--output', required=True, help='folder for the comparison table')
+    add_case_arguments(compare_parser)
+    compare_parser.add_argument('--providers', nargs='+', default=['threshold', 'watershed'],
+                                choices=['threshold', 'watershed', 'resunet'], help='segmentation methods to compare')
+    add_mask_arguments(compare_parser)
+    compare_parser.add_argument('--table', default='mask_compare.xlsx', help='comparison table file name')
+    compare_parser.set_defaults(func=compare_command)
+
+    thresholds_parser = subparsers.add_parser('thresholds', help='cohort PBV quantiles and Otsu thresholds')
+    thresholds_parser.add_argument('--output', required=True, help='root folder given to run --stats')
+    thresholds_parser.add_argument('--save', default='cohort.pbvcohort.npz', help='merged cohort histogram file name')
+    thresholds_parser.set_defaults(func=thresholds_command)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
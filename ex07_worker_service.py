@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+#
+# Title: 常驻的本地计算服务，避免每次运行脚本都重新导入pydicom/scikit-image/pandas/matplotlib
+# Author:
+# Refer:
+# Repo:
+# Date: 2024-12-xx
+#
+# 用法:
+#   python ex07_worker_service.py serve --port 8765
+#   python ex07_worker_service.py submit slice '{"ct": "...\\CT\\IMG-0002-00137.dcm", "pbv": "...\\PBV\\IMG-0002-00137.dcm"}'
+#   python ex07_worker_service.py submit case '{"input": "E:\\cjfh\\dectpe\\raw\\case50", "case": "case18"}'
+#   python ex07_worker_service.py submit cohort '{"input": "...", "output": "...", "cases": ["case001", "case002"]}'
+#
+# 服务只监听127.0.0.1，请求为POST /<job>，请求体为JSON，结果以每行一个JSON对象的形式流式返回。
+# 请求的Content-Type必须为application/json，Host必须为127.0.0.1:<port>或localhost:<port>。
+#
+
+
+import sys
+import json
+import argparse
+import threading
+import functools
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_PORT = 8765
+DEFAULT_MASK_CACHE_ITEMS = 32
+
+
+# 服务启动时导入并缓存计算模块，之后的请求不再付出导入开销
+@functools.lru_cache(maxsize=None)
+def pipeline():
+    import ex03_mask_perfusion
+    return ex03_mask_perfusion
+
+
+# 服务自己的掩码缓存(按文件内容和分割方法缓存，所有请求共用)，条目数有上限，serve()时设置
+_mask_cache = None
+_mask_cache_lock = threading.Lock()
+
+
+def mask_cache():
+    global _mask_cache
+    with _mask_cache_lock:
+        if _mask_cache is None:
+            import maskprovider
+            _mask_cache = maskprovider.MaskCache(memory_items=DEFAULT_MASK_CACHE_ITEMS)
+        return _mask_cache
+
+
+def configure_mask_cache(memory_items=DEFAULT_MASK_CACHE_ITEMS, cache_dirpath=None):
+    global _mask_cache
+    import maskprovider
+    with _mask_cache_lock:
+        _mask_cache = maskprovider.MaskCache(cache_dirpath, memory_items=memory_items)
+
+
+def mask_provider(job):
+    import maskprovider
+    name = job.get('mask_provider', 'threshold')
+    if name == 'resunet':
+        return maskprovider.get_provider(name, mask_dirname=job.get('mask_dirname', 'MASK'))
+    return maskprovider.get_provider(name)
+
+
+# 同一个CT切片的掩码只计算一次
+def cached_ct_mask(ct_file, job=None):
+    return mask_cache().masks(mask_provider(job or {}), ct_file)
+
+
+# 患者任务只在请求指定mask_provider时使用缓存，否则每个切片直接分割(不计算文件哈希)
+def _case_options(job):
+    options = {key: job[key] for key in _CASE_OPTIONS if key in job}
+    if 'mask_provider' in job:
+        options['mask_provider'] = mask_provider(job)
+        options['mask_cache'] = mask_cache()
+    return options
+
+
+def _counts_dict(counts):
+    names = ['Right_Lung', 'Right_Normal', 'Right_Defect', 'Right_Reduced',
+             'Left_Lung', 'Left_Normal', 'Left_Defect', 'Left_Reduced']
+    return {name: int(count) for name, count in zip(names, counts)}
+
+
+# 单个切片: 返回8个计数
+def run_slice_job(job, emit):
+    import pydicom
+    ex03 = pipeline()
+    lung_mask, right_lung_mask, left_lung_mask = cached_ct_mask(job['ct'], job)
+    pbv_image = pydicom.dcmread(job['pbv']).pixel_array
+    lung_label, side_label, *counts = ex03.classify_lung_perfusion_lean(
+        pbv_image, lung_mask, right_lung_mask, left_lung_mask, job.get('adaptive', True), verbose=False)
+    emit({'ct': job['ct'], **_counts_dict(counts)})
+
+
+_CASE_OPTIONS = ['adaptive', 'compute_workers', 'lean', 'memory_budget', 'save_masks', 'zonal', 'stats',
+                 'write_dicom', 'write_png']
+
+
+# 单个患者: 每写完一个切片返回一行
+def run_case_job(job, emit):
+    ex03 = pipeline()
+    options = _case_options(job)
+    ex03.batch_lung_perfusion(job['input'], job['case'], result_dirpath=job.get('output'),
+                              progress=lambda dcm_file, counts: emit({'case': job['case'], 'file': dcm_file,
+                                                                      **_counts_dict(counts)}),
+                              **options)
+    emit({'case': job['case'], 'done': True})
+
+
+# 一组患者: 每完成一个患者返回一行，某个患者出错时返回错误并继续处理其余患者
+def run_cohort_job(job, emit):
+    ex03 = pipeline()
+    options = _case_options(job)
+    for case_id in job['cases']:
+        try:
+            ex03.batch_lung_perfusion(job['input'], case_id, result_dirpath=job.get('output'), **options)
+        except Exception as e:
+            emit({'case': case_id, 'error': f'{type(e).__name__}: {e}'})
+            continue
+        emit({'case': case_id, 'done': True})
+
+
+JOBS = {
+    'slice': run_slice_job,
+    'case': run_case_job,
+    'cohort': run_cohort_job,
+}
+
+
+class WorkerHandler(BaseHTTPRequestHandler):
+    # HTTP/1.0: 不需要Content-Length，结果写完后关闭连接
+    protocol_version = 'HTTP/1.0'
+
+    # 只接受本机客户端: 浏览器中的网页可以向127.0.0.1发送text/plain等简单请求(不需要预检)，
+    # 或通过DNS重绑定使用其他域名访问，因此检查Content-Type和Host
+    def check_request(self):
+        port = self.server.server_address[1]
+        if self.headers.get('Host') not in (f'127.0.0.1:{port}', f'localhost:{port}'):
+            self.send_error(403, 'Host must be 127.0.0.1 or localhost')
+            return False
+        if self.headers.get_content_type() != 'application/json':
+            self.send_error(415, 'Content-Type must be application/json')
+            return False
+        return True
+
+    def do_POST(self):
+        if not self.check_request():
+            return
+        job_name = self.path.strip('/')
+        if job_name not in JOBS:
+            self.send_error(404, f"unknown job '{job_name}'")
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+
+        # 计算在写入线程中回调emit，这里统一写回客户端
+        lock = threading.Lock()
+
+        def emit(result):
+            line = (json.dumps(result, ensure_ascii=False) + '\n').encode('utf-8')
+            with lock:
+                self.wfile.write(line)
+                self.wfile.flush()
+
+        try:
+            JOBS[job_name](job, emit)
+        except Exception as e:
+            emit({'error': f'{type(e).__name__}: {e}'})
+
+    def log_message(self, format, *args):
+        sys.stderr.write("[worker] %s\n" % (format % args))
+
+
+def serve(port=DEFAULT_PORT, mask_cache_items=DEFAULT_MASK_CACHE_ITEMS, mask_cache_dir=None):
+    pipeline()  # 预先导入
+    configure_mask_cache(mask_cache_items, mask_cache_dir)
+    server = ThreadingHTTPServer(('127.0.0.1', port), WorkerHandler)
+    print(f"Worker service listening on 127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# 客户端: 提交任务，逐行返回结果
+def submit(job_name, job, port=DEFAULT_PORT, timeout=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    body = json.dumps(job).encode('utf-8')
+    connection.request('POST', '/' + job_name, body, {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    if response.status != 200:
+        raise RuntimeError(f"{response.status} {response.reason}")
+    try:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Warm local worker service for DECT lung perfusion.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='start the worker service')
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument('--mask-cache-items', type=int, default=DEFAULT_MASK_CACHE_ITEMS,
+                              help='slices kept in the in-memory mask cache')
+    serve_parser.add_argument('--mask-cache', help='folder of the on-disk mask cache')
+    submit_parser = subparsers.add_parser('submit', help='submit a job and print results')
+    submit_parser.add_argument('job', choices=sorted(JOBS))
+    submit_parser.add_argument('payload', help='job parameters as JSON')
+    submit_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        serve(args.port, args.mask_cache_items, args.mask_cache)
+        return 0
+    status = 0
+    for result in submit(args.job, json.loads(args.payload), args.port):
+        print(json.dumps(result, ensure_ascii=False))
+        if 'error' in result:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
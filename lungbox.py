@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+#
+# Title: 肺外接矩形的裁剪和放回，ex02和ex03共用(只依赖numpy)
+# Author:
+# Refer:
+# Repo:
+# Date: 2024-12-xx
+#
+
+
+import numpy as np
+
+
+# 肺掩码的外接矩形(四周留margin个像素)，返回可直接用于索引的切片；没有肺时为空矩形
+def lung_bounding_box(lung_mask, margin=1):
+    rows = np.flatnonzero(lung_mask.any(axis=1))
+    cols = np.flatnonzero(lung_mask.any(axis=0))
+    if rows.size == 0:
+        return slice(0, 0), slice(0, 0)
+    return (slice(max(rows[0] - margin, 0), min(rows[-1] + margin + 1, lung_mask.shape[0])),
+            slice(max(cols[0] - margin, 0), min(cols[-1] + margin + 1, lung_mask.shape[1])))
+
+
+# 把外接矩形内的结果放回整幅图像，矩形外为0
+def paste_bounding_box(crop, shape, box):
+    full = np.zeros(tuple(shape[:2]) + crop.shape[2:], dtype=crop.dtype)
+    full[box] = crop
+    return full
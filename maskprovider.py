@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+#
+# Title: 可替换的肺分割方法(阈值/分水岭/外部ResUNet掩码)和按内容寻址的掩码缓存
+# Author:
+# Refer:
+# Repo:
+# Date: 2024-12-xx
+#
+# 缓存键为 sha256(CT文件内容 + 分割方法名 + 版本 + 参数)，同一个CT切片用同一种方法只分割(或读取)一次，
+# 灌注分级、不同方法之间的比较等后续任务共用缓存中的掩码。
+# 磁盘缓存每个条目是一个单切片的 .lmk 文件(见maskstore)，按键的前两位分目录保存。
+#
+
+
+import io
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import maskstore
+
+
+# 分割方法的接口: segment() 返回 lung_mask, right_lung_mask, left_lung_mask
+class MaskProvider:
+    name = ''
+    # 分割算法改变时加1，磁盘缓存中旧版本的掩码不再使用
+    version = 1
+    # False: 左右肺由方法自己的规则(如面积大小)决定，缓存时按解剖位置重新分配
+    anatomical_sides = False
+
+    # 影响分割结果的参数，参与缓存键的计算
+    def params(self):
+        return {}
+
+    # 分割结果还依赖CT以外的文件时，返回这些文件内容的摘要
+    def source_digest(self, ct_file):
+        return ''
+
+    def segment(self, ct_file, ct_image):
+        raise NotImplementedError
+
+
+# ex03: 阈值 + 连通区域
+class ThresholdMaskProvider(MaskProvider):
+    name = 'threshold'
+    version = 1
+
+    def segment(self, ct_file, ct_image):
+        from ex03_mask_perfusion import get_ct_mask_from_image
+        return get_ct_mask_from_image(ct_image)
+
+
+# ex02: 分水岭
+class WatershedMaskProvider(MaskProvider):
+    name = 'watershed'
+    version = 1
+
+    def segment(self, ct_file, ct_image):
+        from ex02_segment import watershed_segment_lungs_from_image
+        _, left_lung_mask, right_lung_mask = watershed_segment_lungs_from_image(ct_image)
+        return left_lung_mask | right_lung_mask, right_lung_mask, left_lung_mask
+
+
+# 外部生成的掩码(如ResUNet)，与CT目录同级的 mask_dirname 目录中与CT同名的 .npy/.npz/.png 标签图
+class FileMaskProvider(MaskProvider):
+    name = 'resunet'
+    version = 1
+    # 标签图中已经区分左右肺
+    anatomical_sides = True
+    extensions = ['.npy', '.npz', '.png']
+
+    def __init__(self, mask_dirname='MASK', right_value=1, left_value=2, name=None):
+        '''
+            mask_dirname: 掩码目录名，如 case001/MASK/IMG-0002-00137.npy 对应 case001/CT/IMG-0002-00137.dcm;
+            right_value/left_value: 标签图中右肺和左肺的值;
+        '''
+        self.mask_dirname = mask_dirname
+        self.right_value = right_value
+        self.left_value = left_value
+        if name is not None:
+            self.name = name
+
+    def params(self):
+        return {'mask_dirname': self.mask_dirname, 'right_value': self.right_value, 'left_value': self.left_value}
+
+    def mask_file(self, ct_file):
+        case_path = os.path.dirname(os.path.dirname(os.path.abspath(ct_file)))
+        stem = os.path.splitext(os.path.basename(ct_file))[0]
+        for extension in self.extensions:
+            path = os.path.join(case_path, self.mask_dirname, stem + extension)
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f"No mask for '{ct_file}' in '{os.path.join(case_path, self.mask_dirname)}'.")
+
+    def source_digest(self, ct_file):
+        with open(self.mask_file(ct_file), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def load_label(self, path):
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                return data[data.files[0]]
+        if path.endswith('.png'):
+            from matplotlib.image import imread
+            image = imread(path)
+            if image.ndim == 3:
+                image = image[..., 0]
+            # matplotlib把8位PNG读为0-1的浮点数
+            return np.round(image * 255).astype(np.uint8) if image.dtype.kind == 'f' else image
+        return np.load(path)
+
+    def segment(self, ct_file, ct_image):
+        label_image = self.load_label(self.mask_file(ct_file))
+        if ct_image is not None and label_image.shape != ct_image.shape:
+            raise ValueError(f"Mask shape {label_image.shape} does not match CT shape {ct_image.shape} "
+                             f"for '{ct_file}'.")
+        right_lung_mask = label_image == self.right_value
+        left_lung_mask = label_image == self.left_value
+        return right_lung_mask | left_lung_mask, right_lung_mask, left_lung_mask
+
+
+# 按解剖位置分配左右肺: 病人右侧在LPS坐标系中x较小(轴位图像上一般在左边)
+# orientation: ImageOrientationPatient，前三个值为列号增加方向，没有时按标准轴位处理
+def assign_sides_by_anatomy(lung_mask, right_lung_mask, left_lung_mask, orientation=None):
+    column_x = float(orientation[0]) if orientation is not None else 1.0
+    if abs(column_x) < 1e-3:
+        # 不是轴位图像，无法由列号判断左右
+        return lung_mask, right_lung_mask, left_lung_mask
+    columns = np.arange(lung_mask.shape[1])
+
+    def patient_x(mask):
+        column_counts = mask.sum(axis=0)
+        return column_x * (column_counts @ columns) / column_counts.sum()
+
+    regions = [mask for mask in (right_lung_mask, left_lung_mask) if mask.any()]
+    if len(regions) == 2:
+        swap = patient_x(right_lung_mask) > patient_x(left_lung_mask)
+    elif len(regions) == 1:
+        # 只有一侧肺时与图像中心比较
+        region = regions[0]
+        is_left = patient_x(region) > column_x * (lung_mask.shape[1] - 1) / 2
+        swap = is_left == (region is right_lung_mask)
+    else:
+        swap = False
+    if swap:
+        right_lung_mask, left_lung_mask = left_lung_mask, right_lung_mask
+    return lung_mask, right_lung_mask, left_lung_mask
+
+
+PROVIDERS = {
+    'threshold': ThresholdMaskProvider,
+    'watershed': WatershedMaskProvider,
+    'resunet': FileMaskProvider,
+}
+
+
+def get_provider(name, **params):
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown mask provider '{name}', expected one of {sorted(PROVIDERS)}.")
+    return PROVIDERS[name](**params)
+
+
+# 内存中默认保留的条目数，512x512的切片每个条目(3个bool掩码)约0.75MB
+DEFAULT_MEMORY_ITEMS = 32
+
+
+# 按内容寻址的掩码缓存: 内存中保留最近使用的条目(memory_items=0时不保留)，设置cache_dirpath时同时保存到磁盘
+class MaskCache:
+    def __init__(self, cache_dirpath=None, memory_items=DEFAULT_MEMORY_ITEMS, encoding=maskstore.ENCODING_RLE):
+        self.cache_dirpath = cache_dirpath
+        self.memory_items = memory_items
+        self.encoding = encoding
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, provider, ct_bytes, ct_file=None):
+        digest = hashlib.sha256(ct_bytes)
+        digest.update(json.dumps([provider.name, provider.version, provider.anatomical_sides, provider.params(),
+                                  provider.source_digest(ct_file)], sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dirpath, key[:2], key + '.lmk')
+
+    def _remember(self, key, masks):
+        # 缓存中的掩码被多个任务共用，设为只读
+        for mask in masks:
+            mask.setflags(write=False)
+        with self.lock:
+            self.memory[key] = masks
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+
+    # 返回 lung_mask, right_lung_mask, left_lung_mask，左右肺按解剖位置分配
+    # ct_bytes/ct_image/orientation: 调用者已经读取的CT文件内容、图像和ImageOrientationPatient，避免重复读取
+    def masks(self, provider, ct_file, ct_bytes=None, ct_image=None, orientation=None):
+        if ct_bytes is None:
+            with open(ct_file, 'rb') as f:
+                ct_bytes = f.read()
+        key = self.key(provider, ct_bytes, ct_file)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        if self.cache_dirpath is not None and os.path.exists(self.path(key)):
+            with maskstore.MaskStore(self.path(key)) as store:
+                masks = store.masks(0)
+            with self.lock:
+                self.hits += 1
+            self._remember(key, masks)
+            return masks
+
+        if ct_image is None or (orientation is None and not provider.anatomical_sides):
+            import pydicom
+            ct_data = pydicom.dcmread(io.BytesIO(ct_bytes), stop_before_pixels=ct_image is not None)
+            orientation = ct_data.get('ImageOrientationPatient')
+            if ct_image is None:
+                ct_image = ct_data.pixel_array
+        masks = tuple(np.asarray(mask, dtype=bool) for mask in provider.segment(ct_file, ct_image))
+        if not provider.anatomical_sides:
+            masks = assign_sides_by_anatomy(*masks, orientation)
+        with self.lock:
+            self.misses += 1
+        if self.cache_dirpath is not None:
+            # 先写临时文件再改名，多个线程或进程同时写入同一条目时不会读到不完整的文件
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with maskstore.MaskStoreWriter(tmp_path, masks[0].shape, 1, self.encoding) as writer:
+                writer.add(0, *masks, name=os.path.basename(ct_file))
+            os.replace(tmp_path, path)
+        self._remember(key, masks)
+        return masks
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+# 进程内共用的内存缓存
+def default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = MaskCache()
+        return _default_cache
+
+
+def dice_coefficient(mask_a, mask_b):
+    total = np.count_nonzero(mask_a) + np.count_nonzero(mask_b)
+    if total == 0:
+        return 1.0
+    return 2.0 * np.count_nonzero(mask_a & mask_b) / total
+
+
+# 逐切片比较多种分割方法(两两计算全肺、右肺、左肺的Dice)，每个CT文件只读取一次
+def compare_mask_providers(ct_files, providers, cache=None):
+    import pandas as pd
+    if cache is None:
+        cache = default_cache()
+    rows = []
+    for ct_file in ct_files:
+        with open(ct_file, 'rb') as f:
+            ct_bytes = f.read()
+        masks = {provider.name: cache.masks(provider, ct_file, ct_bytes) for provider in providers}
+        for i, provider_a in enumerate(providers):
+            for provider_b in providers[i + 1:]:
+                masks_a, masks_b = masks[provider_a.name], masks[provider_b.name]
+                rows.append([os.path.basename(ct_file), provider_a.name, provider_b.name] +
+                            [dice_coefficient(a, b) for a, b in zip(masks_a, masks_b)])
+    return pd.DataFrame(rows, columns=['File_Name', 'Provider_A', 'Provider_B', 'Lung_Dice', 'Right_Dice',
+                                       'Left_Dice'])
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+#
+# Title: 肺掩码的紧凑存储(位压缩/游程编码)，每个患者一个文件，支持随机读取切片
+# Author:
+# Refer:
+# Repo:
+# Date: 2024-12-xx
+#
+# 文件格式(小端):
+#   头部16字节: b'LMSK', 版本(uint8), 编码(uint8), 保留(2字节), 切片数(uint32), 行数(uint16), 列数(uint16)
+#   偏移表: int64[切片数+1]，每个切片数据在数据区中的起止位置
+#   文件名: uint32长度 + UTF-8 JSON列表
+#   数据区: 每个切片依次存放全肺、右肺、左肺三个掩码
+#
+
+
+import json
+import struct
+import numpy as np
+
+
+MAGIC = b'LMSK'
+VERSION = 1
+ENCODING_PACKBITS = 0   # np.packbits位压缩，每个掩码固定 行*列/8 字节
+ENCODING_RLE = 1        # 游程编码，从0开始交替记录0和1的长度
+_HEADER = struct.Struct('<4sBBxxIHH')
+
+
+# 游程编码: 返回从0开始交替的游程长度
+def rle_encode(mask):
+    flat = np.asarray(mask, dtype=bool).ravel()
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], change, [flat.size])))
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs
+
+
+def rle_decode(runs, shape):
+    values = np.zeros(len(runs), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, runs).reshape(shape)
+
+
+# 直接由游程得到掩码内像素的一维索引，不生成整幅的掩码
+def rle_to_index(runs):
+    bounds = np.cumsum(runs)
+    lengths = runs[1::2]
+    starts = bounds[0::2][:len(lengths)]
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+
+
+def _encode_runs(runs):
+    # 游程长度使用能容纳的最小整数类型
+    dtype = np.uint16 if runs.size == 0 or runs.max() < 65536 else np.uint32
+    return struct.pack('<BI', np.dtype(dtype).itemsize, runs.size) + runs.astype('<' + np.dtype(dtype).str[1:]).tobytes()
+
+
+def _decode_runs(buffer, offset):
+    itemsize, n_runs = struct.unpack_from('<BI', buffer, offset)
+    offset += 5
+    runs = np.frombuffer(buffer, dtype='<u%d' % itemsize, count=n_runs, offset=offset).astype(np.int64)
+    return runs, offset + itemsize * n_runs
+
+
+# 把一个切片的三个掩码编码为bytes
+def encode_slice(lung_mask, right_lung_mask, left_lung_mask, encoding=ENCODING_RLE):
+    masks = (lung_mask, right_lung_mask, left_lung_mask)
+    if encoding == ENCODING_PACKBITS:
+        return b''.join(np.packbits(np.asarray(m, dtype=bool).ravel()).tobytes() for m in masks)
+    return b''.join(_encode_runs(rle_encode(m)) for m in masks)
+
+
+# 写入一个患者所有切片的掩码
+class MaskStoreWriter:
+    def __init__(self, path, shape, n_slices, encoding=ENCODING_RLE):
+        '''
+            path: 输出文件;
+            shape: 切片大小(行, 列);
+            n_slices: 切片数，add()可以乱序调用(流水线中多个线程同时写入);
+        '''
+        self.path = path
+        self.shape = tuple(shape)
+        self.encoding = encoding
+        self.blobs = [None] * n_slices
+        self.names = [''] * n_slices
+
+    def add(self, index, lung_mask, right_lung_mask, left_lung_mask, name=''):
+        self.add_encoded(index, encode_slice(lung_mask, right_lung_mask, left_lung_mask, self.encoding), name)
+
+    def add_encoded(self, index, blob, name=''):
+        self.blobs[index] = blob
+        self.names[index] = name
+
+    def close(self):
+        empty = encode_slice(*[np.zeros(self.shape, dtype=bool)] * 3, encoding=self.encoding)
+        blobs = [empty if blob is None else blob for blob in self.blobs]
+        offsets = np.zeros(len(blobs) + 1, dtype='<i8')
+        offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+        names = json.dumps(self.names).encode('utf-8')
+        with open(self.path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, self.encoding, len(blobs), self.shape[0], self.shape[1]))
+            f.write(offsets.tobytes())
+            f.write(struct.pack('<I', len(names)))
+            f.write(names)
+            for blob in blobs:
+                f.write(blob)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+# 读取掩码文件，使用内存映射，只解码需要的切片
+class MaskStore:
+    def __init__(self, path):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, self.encoding, n_slices, rows, cols = _HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"'{path}' is not a lung mask store.")
+        self.shape = (rows, cols)
+        offset = _HEADER.size
+        self.offsets = np.frombuffer(self.buffer, dtype='<i8', count=n_slices + 1, offset=offset)
+        offset += 8 * (n_slices + 1)
+        (names_size,) = struct.unpack_from('<I', self.buffer, offset)
+        offset += 4
+        self.names = json.loads(bytes(self.buffer[offset:offset + names_size]).decode('utf-8'))
+        self.data_offset = offset + names_size
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _slice_buffer(self, index):
+        start = self.data_offset + int(self.offsets[index])
+        end = self.data_offset + int(self.offsets[index + 1])
+        return self.buffer[start:end]
+
+    def _planes(self, index):
+        buffer = self._slice_buffer(index)
+        if self.encoding == ENCODING_PACKBITS:
+            n_bytes = (self.shape[0] * self.shape[1] + 7) // 8
+            return [buffer[i * n_bytes:(i + 1) * n_bytes] for i in range(3)]
+        planes = []
+        offset = 0
+        for _ in range(3):
+            runs, offset = _decode_runs(buffer, offset)
+            planes.append(runs)
+        return planes
+
+    # 返回 lung_mask, right_lung_mask, left_lung_mask
+    def masks(self, index):
+        n_pixels = self.shape[0] * self.shape[1]
+        if self.encoding == ENCODING_PACKBITS:
+            return tuple(np.unpackbits(p, count=n_pixels).view(bool).reshape(self.shape) for p in self._planes(index))
+        return tuple(rle_decode(runs, self.shape) for runs in self._planes(index))
+
+    # 返回三个掩码内像素的一维索引(升序)，可以直接用于分级
+    def indices(self, index):
+        if self.encoding == ENCODING_PACKBITS:
+            n_pixels = self.shape[0] * self.shape[1]
+            return tuple(np.flatnonzero(np.unpackbits(p, count=n_pixels)) for p in self._planes(index))
+        return tuple(rle_to_index(runs) for runs in self._planes(index))
+
+    def close(self):
+        self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+#
+# Title: 归一化PBV值的流式统计(固定分箱直方图)，用于在整个队列上标定阈值
+# Author:
+# Refer:
+# Repo:
+# Date: 2024-12-xx
+#
+# 直方图按左右肺分开统计，可以直接相加合并，每个患者保存一个.npz文件，
+# 队列的分位数和Otsu阈值只需读取这些小文件，不需要重新读取DICOM。
+#
+
+
+import threading
+import numpy as np
+
+
+N_BINS = 1024
+SIDE_NAMES = ['Right', 'Left']
+
+
+class PerfusionHistogram:
+    def __init__(self, counts=None, nbins=N_BINS):
+        '''
+            counts: 形状为(2, nbins)的计数，第0行为右肺，第1行为左肺;
+        '''
+        if counts is None:
+            counts = np.zeros((2, nbins), dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.nbins = self.counts.shape[1]
+        self.lock = threading.Lock()
+
+    # 加入一个切片肺内像素的归一化值(0-1)，lung_sides为对应的左右肺标签(1右肺，2左肺，0不统计)
+    def add_slice(self, lung_values, lung_sides):
+        bins = np.minimum((np.asarray(lung_values) * self.nbins).astype(np.intp), self.nbins - 1)
+        keys = np.asarray(lung_sides, dtype=np.intp) * self.nbins + bins
+        counts = np.bincount(keys, minlength=3 * self.nbins)[self.nbins:].reshape(2, self.nbins)
+        # 流水线中多个计算线程同时加入
+        with self.lock:
+            self.counts += counts
+
+    def merge(self, other):
+        with self.lock:
+            self.counts += other.counts
+        return self
+
+    def total(self, side=None):
+        return int(self.side_counts(side).sum())
+
+    # side: 0右肺，1左肺，None为双肺
+    def side_counts(self, side=None):
+        return self.counts.sum(axis=0) if side is None else self.counts[side]
+
+    def bin_centers(self):
+        return (np.arange(self.nbins) + 0.5) / self.nbins
+
+    # 由累计直方图在分箱内线性插值得到分位数
+    def quantile(self, q, side=None):
+        counts = self.side_counts(side)
+        total = counts.sum()
+        if total == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        cumulative = np.concatenate(([0], np.cumsum(counts))) / total
+        edges = np.arange(self.nbins + 1) / self.nbins
+        return np.interp(q, cumulative, edges)
+
+    def otsu_threshold(self, side=None):
+        counts = self.side_counts(side)
+        if counts.sum() == 0:
+            return np.nan
+        from skimage.filters import threshold_otsu
+        return threshold_otsu(hist=(counts, self.bin_centers()))
+
+    def save(self, path):
+        np.savez(path, counts=self.counts)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['counts'])
+
+
+# 合并多个患者的直方图
+def merge_histograms(paths):
+    cohort = None
+    for path in paths:
+        histogram = PerfusionHistogram.load(path)
+        cohort = histogram if cohort is None else cohort.merge(histogram)
+    return cohort
+
+
+# 输出阈值标定所需的统计量
+def threshold_summary(histogram, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    summary = {}
+    for side, name in [(0, 'Right'), (1, 'Left'), (None, 'Lung')]:
+        summary[name] = {
+            'count': histogram.total(side),
+            'otsu': float(histogram.otsu_threshold(side)),
+            'quantiles': {str(q): float(v) for q, v in zip(quantiles, histogram.quantile(quantiles, side))},
+        }
+    return summary